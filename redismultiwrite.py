@@ -20,11 +20,26 @@ write operations to several extra specified hosts before returning.
 
 """
 
+import os
+import sys
+import mmap
+import time
+import fcntl
+import random
+import bisect
+import struct
+import fnmatch
+import hashlib
 import logging
+import inspect
+import tempfile
+import itertools
+import threading
+import cPickle as pickle
+from collections import deque, OrderedDict
+from Queue import Queue, Empty
 
 import redis
-from eventlet.greenpool import GreenPool, GreenPile
-from eventlet import greenthread
 
 
 class RedisMultiWriteError(redis.RedisError):
@@ -35,21 +50,1120 @@ class RedisMultiWriteError(redis.RedisError):
 class TooManyRetries(RedisMultiWriteError, redis.ConnectionError):
     """Exception thrown when an operation exceeds its allowed number of retries.
     Inherits from :exc:`RedisMultiWriteError` and :exc:`redis.ConnectionError`.
+    The host name of the connection is available as :attr:`host`, and its
+    ``host:port`` as :attr:`address`.
     
     """
-    def __init__(self, exc, host):
+    def __init__(self, exc, host, address=None):
         super(TooManyRetries, self).__init__(exc.message)
         self.host = host
+        self.address = address
+
+
+class QuorumNotReached(RedisMultiWriteError):
+    """Exception thrown when fewer remote connections than required by
+    ``min_remote_acks`` succeeded. The local operation has already been
+    performed, and its return value is available as :attr:`result`.
+
+    """
+    def __init__(self, acks, required, result):
+        msg = 'Only {0} of {1} required remote writes succeeded'
+        super(QuorumNotReached, self).__init__(msg.format(acks, required))
+        self.acks = acks
+        self.required = required
+        self.result = result
+
+
+class DeadlineExceeded(RedisMultiWriteError):
+    """Exception thrown when an operation does not finish within the
+    ``timeout`` given to it. If the local operation had already finished,
+    its return value is available as :attr:`result`. If the deadline passed
+    while retrying one connection, its host name is available as
+    :attr:`host`, and its ``host:port`` as :attr:`address`.
+
+    """
+    def __init__(self, message, host=None, result=None, address=None):
+        super(DeadlineExceeded, self).__init__(message)
+        self.host = host
+        self.result = result
+        self.address = address
+
+
+def _remaining(deadline):
+    # Returns the seconds left until the deadline, or None for no deadline.
+    if deadline is not None:
+        return max(deadline - time.time(), 0)
+
+
+class _EventletBackend(object):
+    # Runs operations in eventlet greenthreads, which perform their socket
+    # operations simultaneously once the application is monkey-patched.
+
+    def __init__(self, pool_size):
+        from eventlet.greenpool import GreenPool
+        from eventlet.event import Event
+        from eventlet.queue import LightQueue
+        from eventlet.semaphore import Semaphore
+        from eventlet.timeout import Timeout
+        from eventlet import greenthread
+        self.timeout = Timeout
+        self.pool = GreenPool(pool_size) if pool_size else GreenPool()
+        self.background = greenthread.spawn
+        self.sleep = greenthread.sleep
+        self.event = Event
+        self.queue = LightQueue
+        self.lock = Semaphore
+
+    def spawn(self, func, *args):
+        return self.pool.spawn(func, *args)
+
+    def wait(self, thread, timeout=None):
+        if timeout is None:
+            return thread.wait()
+        with self.timeout(timeout, DeadlineExceeded('Deadline exceeded')):
+            return thread.wait()
+
+
+class _ThreadEvent(object):
+    # Gives threading.Event the interface of eventlet.event.Event.
+
+    def __init__(self):
+        self.event = threading.Event()
+
+    def send(self):
+        self.event.set()
+
+    def wait(self, timeout=None):
+        self.event.wait(timeout)
+
+
+class _ThreadFuture(object):
+    # Gives a concurrent.futures.Future the interface of a GreenThread.
+
+    def __init__(self, future):
+        self.future = future
+
+    def wait(self, timeout=None):
+        from concurrent.futures import TimeoutError
+        try:
+            return self.future.result(timeout)
+        except TimeoutError:
+            raise DeadlineExceeded('Deadline exceeded')
+
+
+class _ThreadBackend(object):
+    # Runs operations in a pool of native threads, for applications that do
+    # not use eventlet.
+
+    def __init__(self, pool_size):
+        from concurrent.futures import ThreadPoolExecutor
+        self.pool = ThreadPoolExecutor(pool_size or 100)
+        self.sleep = time.sleep
+        self.event = _ThreadEvent
+        self.queue = lambda maxsize=None: Queue(maxsize or 0)
+        self.lock = threading.Lock
+
+    def spawn(self, func, *args):
+        return _ThreadFuture(self.pool.submit(func, *args))
+
+    def wait(self, future, timeout=None):
+        return future.wait(timeout)
+
+    def background(self, func, *args):
+        thread = threading.Thread(target=func, args=args)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+class _InlineResult(object):
+    # Holds the outcome of an operation that has already run.
+
+    def __init__(self, func, args):
+        self.result = self.exc_info = None
+        try:
+            self.result = func(*args)
+        except Exception:
+            self.exc_info = sys.exc_info()
+
+    def wait(self):
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+
+class _InlineBackend(object):
+    # Runs every operation in the calling thread, one after another.
+
+    sleep = staticmethod(time.sleep)
+    event = _ThreadEvent
+    lock = threading.Lock
+
+    def __init__(self, pool_size):
+        pass
+
+    def spawn(self, func, *args):
+        return _InlineResult(func, args)
+
+    def wait(self, result, timeout=None):
+        return result.wait()
+
+
+_backends = {'eventlet': _EventletBackend,
+             'threads': _ThreadBackend,
+             'inline': _InlineBackend}
+
+
+class _HostStats(object):
+    # Counters and per-command latency histograms for a single host.
+
+    counters = ('sent', 'successes', 'retries', 'too_many_retries', 'errors')
+    buckets = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0,
+               2.0, 5.0, float('inf'))
+
+    def __init__(self):
+        self.counts = dict.fromkeys(self.counters, 0)
+        self.latency = {}
+
+    def observe(self, command, seconds):
+        histogram = self.latency.get(command)
+        if histogram is None:
+            histogram = self.latency[command] = [0] * len(self.buckets)
+        histogram[bisect.bisect_left(self.buckets, seconds)] += 1
+
+    def snapshot(self):
+        snapshot = dict(self.counts)
+        snapshot['latency'] = dict(
+            (command, zip(self.buckets, histogram))
+            for command, histogram in self.latency.iteritems())
+        return snapshot
+
+
+#: The :class:`~redis.StrictRedis` methods that modify data, replicated by
+#: their plain names when ``auto_replicate`` is enabled. Blocking pops and
+#: ``spop`` are left out, since they would block or pick a different member
+#: on each instance.
+WRITE_COMMANDS = frozenset([
+    'append', 'bitop', 'decr', 'delete', 'expire', 'expireat', 'geoadd',
+    'getset', 'hdel', 'hincrby', 'hincrbyfloat', 'hmset', 'hset', 'hsetnx',
+    'incr', 'incrby', 'incrbyfloat', 'linsert', 'lpop', 'lpush', 'lpushx',
+    'lrem', 'lset', 'ltrim', 'move', 'mset', 'msetnx', 'persist', 'pexpire',
+    'pexpireat', 'pfadd', 'pfmerge', 'psetex', 'rename', 'renamenx',
+    'restore', 'rpop', 'rpoplpush', 'rpush', 'rpushx', 'sadd', 'sdiffstore',
+    'set', 'setbit', 'setex', 'setnx', 'setrange', 'sinterstore', 'smove',
+    'srem', 'sunionstore', 'zadd', 'zincrby', 'zinterstore', 'zrem',
+    'zremrangebylex', 'zremrangebyrank', 'zremrangebyscore', 'zunionstore'])
+
+#: The keyword arguments taken by RedisMultiWrite itself, rather than by the
+#: command, when a write is called by its plain name.
+_options = ('min_remote_acks', 'timeout', 'lane', 'token')
+
+
+def _positional(command, args, kwargs):
+    # Turns the keyword arguments of a redis-py write into positional ones,
+    # since commands are passed around as (name, args) pairs.
+    if not kwargs:
+        return args
+    if command in ('mset', 'msetnx'):
+        mapping = dict(*args)
+        mapping.update(kwargs)
+        return (mapping, )
+    if command == 'zadd':
+        return args + tuple(itertools.chain.from_iterable(
+            (score, member) for member, score in kwargs.items()))
+    method = getattr(redis.StrictRedis, command, None)
+    if method is None:
+        raise TypeError(command+' takes no keyword arguments')
+    spec = inspect.getargspec(method)
+    bound = inspect.getcallargs(method.im_func, None, *args, **kwargs)
+    defaults = dict(zip(spec.args[::-1], (spec.defaults or ())[::-1]))
+    names = spec.args[1:]
+    while len(names) > len(args) and names[-1] in defaults and \
+            bound[names[-1]] == defaults[names[-1]]:
+        names.pop()
+    return tuple(bound[name] for name in names)
+
+
+_overwrites = frozenset(['set', 'setex', 'psetex', 'delete'])
+_expires = frozenset(['expire', 'pexpire'])
+_increments = {'incr': 1, 'incrby': 1, 'decr': -1}
+
+
+def _coalesce(commands):
+    # Drops commands made redundant by a later command on the same key, and
+    # merges runs of increments. Commands that may touch more than one key,
+    # or that are not understood, are kept in place and nothing is moved
+    # across them.
+    coalesced, keys = [], {}
+    for op, args in commands:
+        if op not in _overwrites and op not in _expires and \
+                op not in _increments or \
+                op == 'set' and len(args) != 2 or \
+                op == 'delete' and len(args) != 1:
+            coalesced.append((op, args))
+            keys = {}
+            continue
+        key = args[0]
+        previous = keys.setdefault(key, [])
+        if op in _overwrites:
+            for i in previous:
+                coalesced[i] = None
+            del previous[:]
+        elif op in _expires:
+            for i in previous:
+                if coalesced[i] and coalesced[i][0] in _expires:
+                    coalesced[i] = None
+        elif previous and coalesced[previous[-1]] and \
+                coalesced[previous[-1]][0] in _increments:
+            last_op, last_args = coalesced[previous[-1]]
+            amount = _increments[last_op] * int((last_args[1:] or [1])[0]) + \
+                _increments[op] * int((args[1:] or [1])[0])
+            coalesced[previous[-1]] = None
+            op, args = 'incrby', (key, amount)
+        previous.append(len(coalesced))
+        coalesced.append((op, args))
+    return [command for command in coalesced if command]
+
+
+#: Commands that may touch keys other than their first argument.
+_multi_key = frozenset(['bitop', 'delete', 'eval', 'evalsha', 'mset',
+                        'msetnx', 'pfmerge', 'rename', 'renamenx', 'rpoplpush',
+                        'sdiffstore', 'sinterstore', 'smove', 'sunionstore',
+                        'zinterstore', 'zunionstore'])
+
+
+def _chunk_keys(commands):
+    # Returns the keys touched by commands, or None if they cannot be told.
+    keys = set()
+    for op, args in commands:
+        key = _command_key(op, args)
+        if key is None or op in _multi_key and not (
+                op == 'delete' and len(args) == 1 or
+                op in ('eval', 'evalsha') and int(args[1]) == 1):
+            return None
+        keys.add(key)
+    return keys
+
+
+class _CommandRecorder(object):
+    # Stands in for a client, capturing the arguments that one of its command
+    # methods would send.
+
+    command = None
+
+    def execute_command(self, *args, **options):
+        self.command = (args, options)
+
+
+class _Window(object):
+    # Sizes the pipelines sent to a single host in the spirit of TCP Vegas:
+    # full pipelines grow while their round trip stays close to the fastest
+    # seen, and shrink once commands start to queue up behind each other. The
+    # number of pipelines worth keeping in flight follows from how much of
+    # the round trip is spent waiting on the network rather than the host.
+
+    max_depth = 16
+
+    def __init__(self, size, max_size):
+        self.size = size
+        self.max_size = max_size
+        self.depth = 1
+        self.base_rtt = None
+        self.rtt = None
+
+    def update(self, commands, elapsed):
+        if self.base_rtt is None:
+            self.base_rtt = self.rtt = elapsed
+        self.base_rtt = min(elapsed, self.base_rtt * 1.01)
+        self.rtt = 0.8 * self.rtt + 0.2 * elapsed
+        busy = self.rtt - self.base_rtt
+        if busy > 0:
+            self.depth = max(1, min(self.max_depth, int(self.rtt / busy)))
+        else:
+            self.depth = self.max_depth
+        if commands < self.size:
+            return
+        queued = busy / self.rtt if self.rtt else 0.0
+        if queued < 0.1:
+            self.size = min(self.max_size, self.size + max(1, self.size // 4))
+        elif queued > 0.3:
+            self.size = max(1, self.size - self.size // 4)
+
+    def failure(self):
+        self.size = max(1, self.size // 2)
+        self.depth = 1
+
+
+class _Replication(object):
+    # Tracks the writes of a single call to the remote connections, so that
+    # the caller may wait until enough of them have succeeded. It is also
+    # handed to callers as the token for wait_replicated().
+
+    def __init__(self, backend, hosts, seq=None, watermarks=None):
+        self.backend = backend
+        self.lock = backend.lock()
+        self.seq = seq
+        self.watermarks = watermarks
+        self.hosts = frozenset(hosts)
+        self.pending = len(hosts)
+        self.acks = 0
+        self.finished = set()
+        self.acked = set()
+        self.waiters = []
+
+    def finish(self, ok=False, host=None):
+        with self.lock:
+            self.pending -= 1
+            self.finished.add(host)
+            if ok:
+                self.acks += 1
+                self.acked.add(host)
+            ready = [waiter for waiter in self.waiters
+                     if self._ready(*waiter[:2])]
+            for waiter in ready:
+                self.waiters.remove(waiter)
+        if self.watermarks is not None:
+            self.watermarks[host].finish(self.seq, ok)
+        for acks, hosts, event in ready:
+            event.send()
+
+    def _ready(self, acks, hosts=None):
+        if hosts is not None:
+            return hosts <= self.finished
+        return not self.pending or (acks is not None and self.acks >= acks)
+
+    def wait(self, acks=None, timeout=None, hosts=None):
+        # Waits for the given number of successes, for the given hosts to
+        # finish, or for every remote connection to finish, and returns
+        # whether that happened in time.
+        with self.lock:
+            if self._ready(acks, hosts):
+                return True
+            event = self.backend.event()
+            self.waiters.append((acks, hosts, event))
+        event.wait(timeout)
+        return self._ready(acks, hosts)
+
+
+class _Watermark(object):
+    # Tracks the sequence numbers of the writes sent to a single remote
+    # connection, and how many of them failed. Writes start in sequence
+    # order, so the first outstanding write is both the lowest and the
+    # oldest.
+
+    def __init__(self, lock):
+        self.lock = lock
+        self.issued = 0
+        self.outstanding = OrderedDict()
+        self.failed = 0
+        self.failed_at = None
+
+    def start(self, seq):
+        with self.lock:
+            self.issued = seq
+            self.outstanding[seq] = time.time()
+
+    def finish(self, seq, ok):
+        with self.lock:
+            self.outstanding.pop(seq, None)
+            if not ok:
+                self.failed += 1
+                self.failed_at = time.time()
+
+    def snapshot(self):
+        with self.lock:
+            now = time.time()
+            snapshot = {'finished': self.issued, 'in_flight': 0,
+                        'oldest_age': 0.0, 'failed': self.failed,
+                        'last_failure_age': None}
+            if self.failed_at is not None:
+                snapshot['last_failure_age'] = now - self.failed_at
+            if self.outstanding:
+                seq, started = next(self.outstanding.iteritems())
+                snapshot.update(finished=seq - 1,
+                                in_flight=len(self.outstanding),
+                                oldest_age=now - started)
+            return snapshot
+
+
+class _CircuitBreaker(object):
+    # Stops sending to a remote connection after repeated failures. Once the
+    # timeout passes, a single PING decides whether to close the circuit.
+
+    closed, open, half_open = 'closed', 'open', 'half-open'
+
+    def __init__(self, rmw, conn):
+        self.rmw = rmw
+        self.conn = conn
+        self.lock = rmw.backend.lock()
+        self.state = self.closed
+        self.failures = 0
+        self.opened_at = None
+
+    def allow(self):
+        with self.lock:
+            if self.state == self.closed:
+                return True
+            if self.state == self.half_open or \
+                    time.time() - self.opened_at < self.rmw.breaker_timeout:
+                return False
+            self.state = self.half_open
+        try:
+            self.conn.ping()
+        except redis.RedisError:
+            self._open()
+            return False
+        self.rmw.log.info('Circuit closed for '+self.rmw._host(self.conn))
+        self.state = self.closed
+        self.failures = 0
+        return True
+
+    def _open(self):
+        self.state = self.open
+        self.opened_at = time.time()
+
+    def success(self):
+        self.failures = 0
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state != self.closed or \
+                    self.failures < self.rmw.breaker_threshold:
+                return
+            self._open()
+        self.rmw.log.error('Circuit opened for '+self.rmw._host(self.conn))
+
+
+class _TokenBucket(object):
+    # Allows a given rate per second, in bursts of up to one second's worth.
+    # Taking more than is available leaves a debt that later takers wait out,
+    # so callers queue up in order rather than fail.
+
+    def __init__(self, rate, lock):
+        self.rate = float(rate)
+        self.lock = lock
+        self.tokens = self.rate
+        self.updated = time.time()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.tokens + (now - self.updated) * self.rate,
+                          self.rate)
+        self.updated = now
+
+    def take(self, amount):
+        # Returns the number of seconds to wait before going ahead.
+        with self.lock:
+            self._refill()
+            self.tokens -= amount
+            return max(-self.tokens / self.rate, 0)
+
+    def utilization(self):
+        # Zero when idle, about one at the limit, and above one when callers
+        # are waiting.
+        with self.lock:
+            self._refill()
+            return (self.rate - self.tokens) / self.rate
+
+
+def _arg_size(arg):
+    # Returns the bytes sent for an argument, encoding unicode as UTF-8.
+    if isinstance(arg, unicode):
+        return len(arg.encode('utf-8'))
+    return len(str(arg))
+
+
+def _command_size(commands):
+    # Estimates the bytes sent for commands, ignoring protocol overhead.
+    return sum(len(op) + sum(_arg_size(arg) for arg in args)
+               for op, args in commands)
+
+
+class _Spill(object):
+    # An on-disk overflow for a remote queue. Commands are read back in the
+    # order they were written once the queue has room for them again.
+
+    def __init__(self, spill_dir):
+        self.file = tempfile.TemporaryFile(dir=spill_dir)
+        self.read_pos = 0
+        self.replications = deque()
+
+    def __len__(self):
+        return len(self.replications)
+
+    def append(self, commands, replication):
+        self.file.seek(0, os.SEEK_END)
+        pickle.dump(commands, self.file, pickle.HIGHEST_PROTOCOL)
+        self.replications.append(replication)
+
+    def pop(self):
+        self.file.seek(self.read_pos)
+        commands = pickle.load(self.file)
+        self.read_pos = self.file.tell()
+        replication = self.replications.popleft()
+        if not self.replications:
+            self.file.seek(0)
+            self.file.truncate()
+            self.read_pos = 0
+        return commands, replication
+
+
+class _Journal(object):
+    # A durable, append-only log of the commands that could not be sent to a
+    # remote connection, which several processes may share. The header holds
+    # the offset of the first entry not yet acknowledged by the remote
+    # connection and the number of entries from there on, and acknowledged
+    # entries are compacted away as they pile up. Every change is made under
+    # an exclusive lock on the file, and only the process holding the lock on
+    # the ".replay" file beside it replays the journal.
+
+    header = struct.Struct('>QQ')
+    length = struct.Struct('>I')
+    compact_size = 1024 * 1024
+
+    def __init__(self, path, lock):
+        self.path = path
+        self.lock = lock
+        self.replaying = False
+        self.claimed = False
+        self.claim_file = open(path + '.replay', 'a')
+        self._open()
+        self._lock()
+        try:
+            self._recover()
+        finally:
+            self._unlock()
+
+    def __len__(self):
+        self._lock()
+        try:
+            return self._read_header()[1]
+        finally:
+            self._unlock()
+
+    def _open(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0600)
+        # Unbuffered, so that writes by other processes are always seen.
+        self.file = os.fdopen(fd, 'r+b', 0)
+
+    def _lock(self):
+        self.lock.acquire()
+        while True:
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+            try:
+                current = os.stat(self.path).st_ino
+            except OSError:
+                current = None
+            if current == os.fstat(self.file.fileno()).st_ino:
+                break
+            # Another process has compacted the journal into a new file.
+            self.file.close()
+            self._open()
+        self.file.seek(0, os.SEEK_END)
+        if self.file.tell() < self.header.size:
+            self._write_header(self.header.size, 0)
+
+    def _unlock(self):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.lock.release()
+
+    def _recover(self):
+        # Counts the unacknowledged entries, cutting off an entry left
+        # incomplete by a crash during an append.
+        start, pending = self._read_header()
+        self.file.seek(0, os.SEEK_END)
+        end = self.file.tell()
+        pos, pending = start, 0
+        while pos + self.length.size <= end:
+            self.file.seek(pos)
+            size = self.length.unpack(self.file.read(self.length.size))[0]
+            if pos + self.length.size + size > end:
+                break
+            pos += self.length.size + size
+            pending += 1
+        if pos < end:
+            self.file.truncate(pos)
+        self._write_header(start, pending)
+
+    def start_replay(self):
+        # Returns True if the caller should start replaying the journal.
+        with self.lock:
+            started, self.replaying = not self.replaying, True
+            return started
+
+    def claim(self):
+        # Returns True if this process may replay the journal.
+        if not self.claimed:
+            try:
+                fcntl.flock(self.claim_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return False
+            self.claimed = True
+        return True
+
+    def stop_replay(self):
+        # Returns True if nothing remains and the caller should stop.
+        self._lock()
+        try:
+            self.replaying = bool(self._read_header()[1])
+            if not self.replaying and self.claimed:
+                fcntl.flock(self.claim_file, fcntl.LOCK_UN)
+                self.claimed = False
+            return not self.replaying
+        finally:
+            self._unlock()
+
+    def release(self):
+        # Gives up replaying, so that another process may claim the journal.
+        with self.lock:
+            self.replaying = False
+            if self.claimed:
+                fcntl.flock(self.claim_file, fcntl.LOCK_UN)
+                self.claimed = False
+
+    def _read_header(self):
+        self.file.seek(0)
+        return self.header.unpack(self.file.read(self.header.size))
+
+    def _write_header(self, pos, pending):
+        self.file.seek(0)
+        self.file.write(self.header.pack(pos, pending))
+        self._sync()
+
+    def _sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def append(self, commands):
+        data = pickle.dumps(list(commands), pickle.HIGHEST_PROTOCOL)
+        self._lock()
+        try:
+            pos, pending = self._read_header()
+            self.file.seek(0, os.SEEK_END)
+            self.file.write(self.length.pack(len(data)) + data)
+            self._sync()
+            self._write_header(pos, pending + 1)
+        finally:
+            self._unlock()
+
+    def read(self, limit):
+        # Returns up to about limit unacknowledged commands, in order, along
+        # with the number of entries read, the offset following them, and the
+        # number of entries that could not be decoded and were skipped.
+        commands, entries, skipped = [], 0, 0
+        self._lock()
+        try:
+            pos, pending = self._read_header()
+            self.file.seek(pos)
+            while entries < pending and len(commands) < limit:
+                size = self.length.unpack(self.file.read(self.length.size))[0]
+                data = self.file.read(size)
+                pos += self.length.size + size
+                entries += 1
+                try:
+                    commands.extend(pickle.loads(data))
+                except Exception:
+                    skipped += 1
+        finally:
+            self._unlock()
+        return commands, entries, pos, skipped
+
+    def ack(self, entries, pos):
+        self._lock()
+        try:
+            pending = self._read_header()[1] - entries
+            if not pending:
+                self.file.truncate(self.header.size)
+                self._write_header(self.header.size, 0)
+            elif pos >= self.compact_size:
+                self._compact(pos, pending)
+            else:
+                self._write_header(pos, pending)
+        finally:
+            self._unlock()
+
+    def _compact(self, pos, pending):
+        # Copies the unacknowledged entries into a fresh journal.
+        compacted = self.path + '.compact'
+        with open(compacted, 'wb') as new:
+            new.write(self.header.pack(self.header.size, pending))
+            self.file.seek(pos)
+            while True:
+                data = self.file.read(65536)
+                if not data:
+                    break
+                new.write(data)
+            new.flush()
+            os.fsync(new.fileno())
+        os.rename(compacted, self.path)
+        self.file.close()
+        self._open()
+
+
+class _Ring(object):
+    # A fixed-size circular buffer of command lists in a memory-mapped file,
+    # written by any number of processes and drained by one replicator
+    # process. The header holds the total number of bytes ever written and
+    # read, and every change is made under an exclusive lock on the file.
+
+    header = struct.Struct('>QQ')
+    length = struct.Struct('>I')
+
+    def __init__(self, path, size, lock):
+        self.lock = lock
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+        self.file = os.fdopen(fd, 'r+b')
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        try:
+            # An existing ring keeps the size it was created with.
+            self.file.seek(0, os.SEEK_END)
+            if not self.file.tell():
+                self.file.truncate(self.header.size + size)
+            self.size = os.fstat(fd).st_size - self.header.size
+        finally:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+
+    def _lock(self):
+        self.lock.acquire()
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+
+    def _unlock(self):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.lock.release()
+
+    def _copy_in(self, pos, data):
+        offset = pos % self.size
+        first = min(len(data), self.size - offset)
+        start = self.header.size + offset
+        self.map[start:start+first] = data[:first]
+        rest = len(data) - first
+        self.map[self.header.size:self.header.size+rest] = data[first:]
+
+    def _copy_out(self, pos, size):
+        offset = pos % self.size
+        first = min(size, self.size - offset)
+        start = self.header.size + offset
+        rest = size - first
+        return self.map[start:start+first] + \
+            self.map[self.header.size:self.header.size+rest]
+
+    def append(self, commands):
+        # Returns False if the ring has no room for the commands.
+        data = pickle.dumps(list(commands), pickle.HIGHEST_PROTOCOL)
+        data = self.length.pack(len(data)) + data
+        if len(data) > self.size:
+            raise ValueError('Commands are too large for the ring')
+        self._lock()
+        try:
+            written, read = self.header.unpack_from(self.map)
+            if written - read + len(data) > self.size:
+                return False
+            self._copy_in(written, data)
+            self.header.pack_into(self.map, 0, written + len(data), read)
+            return True
+        finally:
+            self._unlock()
+
+    def read(self, limit):
+        # Returns up to about limit unread commands, in order, along with the
+        # position to acknowledge once they are sent.
+        commands = []
+        self._lock()
+        try:
+            written, pos = self.header.unpack_from(self.map)
+            while pos < written and len(commands) < limit:
+                size = self.length.unpack(self._copy_out(pos,
+                                                         self.length.size))[0]
+                pos += self.length.size
+                commands.extend(pickle.loads(self._copy_out(pos, size)))
+                pos += size
+        finally:
+            self._unlock()
+        return commands, pos
+
+    def ack(self, pos):
+        self._lock()
+        try:
+            written, read = self.header.unpack_from(self.map)
+            self.header.pack_into(self.map, 0, written, pos)
+        finally:
+            self._unlock()
+
+
+class _RemoteQueue(object):
+    # Holds the commands bound for a single remote connection, drained by a
+    # fixed number of workers. When batching, each worker collects commands
+    # from concurrent callers and sends them together in one pipeline.
+
+    #: Queued once per worker by close(), after the commands already queued.
+    stop = (None, None)
+
+    def __init__(self, rmw, conn, backend):
+        self.rmw = rmw
+        self.conn = conn
+        self.backend = backend
+        self.lock = backend.lock()
+        self.queue = backend.queue(rmw.queue_size)
+        self.spill = None
+        if rmw.overflow == 'spill':
+            self.spill = _Spill(rmw.spill_dir)
+        self.workers = []
+
+    def __len__(self):
+        return self.queue.qsize() + len(self.spill or ())
+
+    def put(self, commands, replication):
+        entry = (commands, replication)
+        with self.lock:
+            if not self.workers:
+                self.workers = [self.backend.background(self._work, i)
+                                for i in range(self.rmw.queue_workers)]
+            if self.spill is not None and (self.spill or self.queue.full()):
+                self.spill.append(*entry)
+                return
+            dropped = None
+            if self.rmw.overflow == 'drop' and self.queue.full():
+                dropped_commands, dropped = self.queue.get_nowait()
+                self.queue.put_nowait(entry)
+        if dropped is not None:
+            self.rmw.log.warn('Dropped queued commands for '+
+                              self.rmw._host(self.conn))
+            dropped.finish(host=self.rmw._host(self.conn))
+        else:
+            self.queue.put(entry)
+
+    def _get(self, timeout=None):
+        # Anything in the spill is newer than everything in memory.
+        try:
+            return self.queue.get_nowait()
+        except Empty:
+            with self.lock:
+                if self.spill:
+                    return self.spill.pop()
+        return self.queue.get(timeout=timeout)
+
+    def close(self):
+        with self.lock:
+            workers, self.workers = self.workers, []
+        for worker in workers:
+            self.queue.put(self.stop)
+
+    def _take(self):
+        # Returns a batch of entries, or None once the worker should stop.
+        entry = self._get()
+        if entry is self.stop:
+            with self.lock:
+                if not self.spill:
+                    return None
+                entry = self.spill.pop()
+            self.queue.put(self.stop)   # Drain the spill first.
+        batch = [entry]
+        size = len(batch[0][0])
+        limit = self.rmw._limits(self.conn, self.rmw.batch_size or 1, 1)[0]
+        flush_at = time.time() + self.rmw.batch_window
+        while size < limit:
+            try:
+                entry = self._get(timeout=max(flush_at - time.time(), 0))
+            except Empty:
+                break
+            if entry is self.stop:
+                self.queue.put(entry)
+                break
+            batch.append(entry)
+            size += len(entry[0])
+        return batch
+
+    def _work(self, index):
+        while True:
+            if index >= self.rmw._limits(self.conn, None, index + 1)[1]:
+                # Too many pipelines in flight for this host right now.
+                self.backend.sleep(self.rmw.batch_window or 0.01)
+                continue
+            batch = self._take()
+            if batch is None:
+                return
+            commands = [cmd for cmds, _ in batch for cmd in cmds]
+            if self.rmw.coalesce:
+                commands = _coalesce(commands)
+            replications = [replication for _, replication in batch]
+            executor, data = self.rmw._executor(commands)
+            self.rmw._replicate(self.conn, executor, data, commands,
+                                replications)
+
+
+def _address(conn):
+    # Returns the host and port of a client as "host:port", or None.
+    try:
+        kwargs = conn.connection_pool.connection_kwargs
+        return '%s:%s' % (kwargs['host'], kwargs.get('port', 6379))
+    except (AttributeError, KeyError):
+        return None
+
+
+def _key_name(key):
+    # Returns a key as redis-py encodes it, or None if it is not a key.
+    if isinstance(key, float):
+        return repr(key)
+    if isinstance(key, (int, long)):
+        return str(key)
+    if not isinstance(key, basestring):
+        return None
+    return key
+
+
+def _command_key(op, args):
+    # Returns the first key of a command, or None if it takes no keys or its
+    # first argument is not a key, such as the mapping given to mset.
+    if op in ('eval', 'evalsha'):
+        return _key_name(args[2]) if int(args[1]) else None
+    return _key_name(args[0]) if args else None
+
+
+def _key_filter(spec):
+    # Turns a glob pattern, a collection of prefixes or a predicate into a
+    # predicate on keys.
+    if callable(spec):
+        return spec
+    if isinstance(spec, basestring):
+        return lambda key: fnmatch.fnmatchcase(key, spec)
+    prefixes = tuple(spec)
+    return lambda key: key.startswith(prefixes)
+
+
+def _crc16(data):
+    # The CRC16-XMODEM checksum used to assign Redis Cluster hash slots.
+    crc = 0
+    for char in data:
+        crc ^= ord(char) << 8
+        for i in range(8):
+            crc = ((crc << 1) ^ 0x1021 if crc & 0x8000 else crc << 1) & 0xffff
+    return crc
+
+
+class ShardedRedis(object):
+    """Groups several redis instances that each hold a share of the keys,
+    such as the shards of a remote datacenter, so that they may be given as
+    a single entry of the ``remote`` list of :class:`RedisMultiWrite`. Each
+    command is routed to the shard owning its first key, and each pipeline
+    is split into one pipeline per shard, sent in parallel. As in Redis
+    Cluster, only the part of a key between ``{`` and ``}``, if any, is used
+    for routing, so related keys may be kept on one shard. Commands that
+    take several keys must keep them on one shard this way, except for
+    ``delete`` and ``mset``, which are split by shard. Other commands whose
+    keys span shards raise :exc:`ValueError`.
+
+    :param shards: A list of :class:`~redis.StrictRedis` objects, one for
+                   each shard.
+    :param routing: ``'consistent'`` places the shards on a consistent hash
+                    ring, so that adding a shard moves few keys.
+                    ``'slots'`` assigns each shard an equal range of the
+                    16384 Redis Cluster hash slots. Default:
+                    ``'consistent'``.
+    :param replicas: The number of points each shard has on the consistent
+                     hash ring. Default: 160.
+    :param name: The name reported for the group, in statistics and the
+                 like. Default: the ``host:port`` of each shard, joined by
+                 commas.
+
+    """
+
+    #: Commands without keys, which are run on every shard.
+    broadcast_commands = frozenset(['ping', 'script_load', 'script_flush',
+                                    'flushdb', 'flushall'])
+
+    def __init__(self, shards, routing='consistent', replicas=160,
+                 name=None):
+        if routing not in ('consistent', 'slots'):
+            raise ValueError('Unknown routing: '+routing)
+        self.shards = shards
+        self.routing = routing
+        hosts = [_address(shard) or str(i) for i, shard in enumerate(shards)]
+        self.name = name or ','.join(hosts)
+        ring = sorted((struct.unpack('>Q', hashlib.md5(
+                          '%s-%d' % (host, i)).digest()[:8])[0], index)
+                      for index, host in enumerate(hosts)
+                      for i in range(replicas))
+        self._points = [point for point, index in ring]
+        self._owners = [index for point, index in ring]
+
+    def index(self, key):
+        """Returns the index in ``shards`` of the shard owning a key.
+
+        :param key: The key to route.
+
+        """
+        start = key.find('{')
+        if start >= 0:
+            end = key.find('}', start + 1)
+            if end > start + 1:
+                key = key[start+1:end]
+        if self.routing == 'slots':
+            return (_crc16(key) % 16384) * len(self.shards) // 16384
+        point = struct.unpack('>Q', hashlib.md5(key).digest()[:8])[0]
+        i = bisect.bisect(self._points, point) % len(self._points)
+        return self._owners[i]
+
+    def route(self, op, args):
+        # Returns the index of the shard for a command, from its first key,
+        # or from the keys of a mapping such as the one given to msetnx.
+        if args and isinstance(args[0], dict):
+            indexes = set(self.index(_key_name(key)) for key in args[0])
+            if len(indexes) > 1:
+                raise ValueError('The keys of %s span several shards' % op)
+            return indexes.pop() if indexes else 0
+        key = _command_key(op, args)
+        return 0 if key is None else self.index(key)
+
+    def split(self, op, args):
+        # Returns (shard index, args) pairs for the part of a command bound
+        # for each shard. Only delete and mset are split.
+        if op == 'delete' and len(args) > 1:
+            groups = {}
+            for name in args:
+                groups.setdefault(self.index(_key_name(name)), []).append(name)
+            return [(index, tuple(group)) for index, group in groups.items()]
+        if op == 'mset' and args and isinstance(args[0], dict):
+            groups = {}
+            for key, value in args[0].items():
+                groups.setdefault(self.index(_key_name(key)), {})[key] = value
+            return [(index, (group, ) + tuple(args[1:]))
+                    for index, group in groups.items()]
+        return [(self.route(op, args), args)]
+
+    def delete(self, *names):
+        return sum(self.shards[index].delete(*part)
+                   for index, part in self.split('delete', names))
+
+    def mset(self, mapping):
+        return all([self.shards[index].mset(*part)
+                    for index, part in self.split('mset', (mapping, ))])
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name in self.broadcast_commands:
+            def broadcast(*args, **kwargs):
+                return [getattr(shard, name)(*args, **kwargs)
+                        for shard in self.shards][0]
+            return broadcast
+        def routed(*args, **kwargs):
+            shard = self.shards[self.route(name, args)]
+            return getattr(shard, name)(*args, **kwargs)
+        return routed
 
 
 class RedisMultiWrite(object):
     """Creates a new RedisMultiWrite object.
 
     :param local: A :class:`~redis.StrictRedis` object representing a
-                  connection to the local redis instance.
+                  connection to the local redis instance. This may be None
+                  for a replicator process, see :meth:`replicate_ring`.
     :param remote: A list of :class:`~redis.StrictRedis` objects
-                   representing connections to remote redis instances.
-                   Default: empty list.
+                   representing connections to remote redis instances, or
+                   :class:`ShardedRedis` objects for remote instances split
+                   into shards. Default: empty list.
     :param retries: The number of times a write operation should be retried
                     on connection errors before failure. If this number is
                     exceeded, :exc:`TooManyRetries` is thrown with the error
@@ -57,109 +1171,855 @@ class RedisMultiWrite(object):
     :param log: The python-style log destination object. Defaults to the
                 standard destination of the :mod:`logging` module.
     :param pool_size: The size of the
-                      :class:`~eventlet.greenpool.GreenPool`. See the
+                      :class:`~eventlet.greenpool.GreenPool`, or the number
+                      of threads with the ``'threads'`` backend. See the
                       referenced documentation for defaults.
     :param wait_for_remote: If False, a request will return as soon as the
                             local connection has handled it and the remote
                             connections will continue in the background.
                             If True, the request will only return once all
                             connections have completed.
+    :param batch_size: If given, commands bound for each remote connection
+                       are collected from concurrent callers and sent
+                       together in a single pipeline of up to this many
+                       commands. Default: no batching.
+    :param batch_window: When batching, the number of seconds to wait for
+                         more commands before sending a pipeline that has
+                         not reached ``batch_size``. Default: 0.005.
+    :param queue_size: If given, each remote connection has a queue holding
+                       at most this many calls waiting to be sent, drained
+                       by a fixed number of workers. Default: unbounded.
+    :param queue_workers: The number of workers draining each remote
+                          connection's queue. Default: 1.
+    :param overflow: What happens when a call finds a remote queue full:
+                     ``'block'`` waits for room, ``'drop'`` discards the
+                     oldest queued call, and ``'spill'`` writes the call to
+                     a temporary file to be sent once there is room.
+                     Default: ``'block'``.
+    :param spill_dir: The directory for ``'spill'`` overflow files.
+                      Defaults to the system temporary directory.
+    :param journal_dir: If given, commands that exceed their retries on a
+                        remote connection are saved to a journal file for
+                        that host in this directory, and replayed in order
+                        once the host is reachable again. Later commands for
+                        the host are journaled behind them until then.
+                        Several processes may share the directory, and one
+                        of them at a time replays each journal.
+                        Default: remote failures are discarded.
+    :param journal_interval: The number of seconds between checks for a
+                             journaled host becoming reachable. Default: 1.0.
+    :param min_remote_acks: If given, requests wait until the local connection
+                            and at least this many remote connections have
+                            succeeded, while the rest continue in the
+                            background. If too few remote connections
+                            succeed, :exc:`QuorumNotReached` is thrown. This
+                            may also be given to each request. Default: 0.
+    :param retry_backoff: If given, retries wait a random time of up to this
+                          many seconds, doubling with each retry. Default:
+                          retries are immediate.
+    :param breaker_threshold: If given, a remote connection whose operations
+                              exceed their retries this many times in a row
+                              is skipped (or journaled) until
+                              ``breaker_timeout`` passes and it answers a
+                              ``PING``. Default: never skipped.
+    :param breaker_timeout: The number of seconds a remote connection is
+                            skipped before it is checked again. Default: 5.0.
+    :param backend: How operations are run simultaneously: ``'eventlet'``
+                    uses greenthreads, ``'threads'`` uses a
+                    :class:`~concurrent.futures.ThreadPoolExecutor` for
+                    applications that do not use eventlet, and ``'inline'``
+                    runs them one after another in the calling thread, which
+                    cannot be combined with batching, queues or journals.
+                    The chosen library is only imported when selected.
+                    Default: ``'eventlet'``.
+    :param stats_hooks: A list of callables, each called as
+                        ``hook(host, command, metric, value)`` whenever a
+                        counter of :meth:`stats` is incremented (with a value
+                        of 1) and with the ``'latency'`` metric and the
+                        number of seconds of each successful operation. Use
+                        this to forward metrics to StatsD, Prometheus and the
+                        like. Default: no hooks.
+    :param encode_once: If True, each command given to :meth:`run_everywhere`
+                        is encoded into the redis protocol once, and the same
+                        buffers are written to every connection, rather than
+                        each connection encoding its own copy of large
+                        values. Every connection must use the same encoding
+                        settings. Pipelines and queued commands are encoded
+                        as usual. Default: False.
+    :param coalesce: If True, commands waiting in a remote queue or journal
+                     are coalesced before being sent: a ``set``, ``setex``,
+                     ``psetex`` or single-key ``delete`` replaces the earlier
+                     commands on its key, a later ``expire`` or ``pexpire``
+                     replaces an earlier one, and runs of ``incr``,
+                     ``incrby`` and ``decr`` on a key are merged into one
+                     ``incrby``. Default: False.
+    :param auto_replicate: If True, the methods named in ``write_commands``
+                           are performed everywhere when called by their
+                           plain names, as if suffixed with ``_everywhere``,
+                           while all other methods stay local. Default:
+                           False.
+    :param write_commands: The method names considered writes by
+                           ``auto_replicate``. Default:
+                           :data:`WRITE_COMMANDS`.
+    :param adaptive_batching: If True, the pipeline size for each host adapts
+                              to its measured round trip times, growing from
+                              ``batch_size`` (or 100) while round trips stay
+                              close to the fastest seen and shrinking once
+                              they grow. The number of queue workers sending
+                              at once, and the chunks in flight for
+                              :meth:`stream_everywhere`, adapt likewise.
+                              This applies to remote queues, journal replay
+                              and :meth:`stream_everywhere`. Default: False.
+    :param max_batch_size: The largest pipeline size adaptive batching may
+                           reach. Default: 10000.
+    :param warmup: If True, ``warmup_connections`` pooled connections to the
+                   local and every remote instance are opened, all at once,
+                   before the constructor returns, so that the first
+                   requests do not pay to connect. Hosts that could not be
+                   reached are logged and listed in :attr:`unreachable`.
+                   Default: False.
+    :param warmup_connections: The number of connections opened to each
+                               instance by ``warmup``, and kept alive by
+                               ``keepalive_interval``. Default: 1.
+    :param keepalive_interval: If given, every this many seconds a ``PING``
+                               is sent on the most recently used pooled
+                               connections to each instance, so that idle
+                               connections are not closed by firewalls or
+                               the server. Default: no keepalive.
+    :param lanes: A dictionary of priority lane names, such as
+                  ``'interactive'`` and ``'bulk'``, to pool sizes. Each lane
+                  has its own pool of the given size (or the backend's
+                  default, for None) and, when queueing, its own queue and
+                  workers for each remote connection, so that calls given
+                  one lane never wait behind calls given another. Calls pick
+                  a lane with their ``lane`` argument, and otherwise share
+                  the pool of ``pool_size``. Default: no lanes.
+    :param key_filters: A dictionary of remote ``host:port`` names to the
+                        keys they should receive: a glob pattern string, a
+                        collection of key prefixes, or a callable given each
+                        key and returning whether to send it. Commands are filtered
+                        by their first key, while commands without keys are
+                        sent everywhere. A remote with nothing to send for a
+                        call is skipped, and counts as having succeeded.
+                        Default: every remote receives every command.
+    :param ring_path: If given, only the local instance is written to, and
+                      the commands for the remote instances are put in a
+                      ring buffer in this shared memory file (such as one in
+                      ``/dev/shm``) instead. One replicator process per host
+                      drains the ring with :meth:`replicate_ring` and holds
+                      the remote connections for every process writing to
+                      it. No ``remote`` may be given, and calls cannot wait
+                      for remote instances or return replication tokens. When the ring is full, calls
+                      wait for room, or drop their remote commands if
+                      ``overflow`` is ``'drop'`` or ``'spill'``. Default:
+                      remote instances are written to by this process.
+    :param ring_size: The number of bytes in a new ring buffer. Default:
+                      64 MiB.
+    :param ring_interval: The number of seconds between checks for room in,
+                          or commands from, the ring. Default: 0.01.
+    :param rate_limits: A dictionary of remote ``host:port`` names to their
+                        limits, each a dictionary with the commands per
+                        second as ``'ops'`` and the bytes per second as
+                        ``'bytes'`` (estimated from the command arguments),
+                        either of which may be left out. Work over the limit waits its
+                        turn rather than failing, and bursts of up to one
+                        second's worth are allowed. :meth:`stats` reports
+                        the current utilization of each limit. Default: no
+                        limits.
 
     """
 
     def __init__(self, local, remote=None, retries=3, log=None, pool_size=None,
-                       wait_for_remote=False):
+                       wait_for_remote=False, batch_size=None,
+                       batch_window=0.005, queue_size=None, queue_workers=1,
+                       overflow='block', spill_dir=None, journal_dir=None,
+                       journal_interval=1.0, min_remote_acks=0,
+                       retry_backoff=0, breaker_threshold=None,
+                       breaker_timeout=5.0, backend='eventlet',
+                       stats_hooks=None, encode_once=False, coalesce=False,
+                       auto_replicate=False, write_commands=WRITE_COMMANDS,
+                       adaptive_batching=False, max_batch_size=10000,
+                       warmup=False, warmup_connections=1,
+                       keepalive_interval=None, lanes=None,
+                       key_filters=None, ring_path=None,
+                       ring_size=64*1024*1024, ring_interval=0.01,
+                       rate_limits=None):
+        if overflow not in ('block', 'drop', 'spill'):
+            raise ValueError('Unknown overflow policy: '+overflow)
+        if backend not in _backends:
+            raise ValueError('Unknown backend: '+backend)
+        if backend == 'inline' and (batch_size or queue_size or journal_dir or
+                                    keepalive_interval):
+            raise ValueError('The inline backend cannot run in the background')
+        if ring_path and (remote or wait_for_remote or min_remote_acks):
+            raise ValueError('Remote connections belong to the replicator '
+                             'process of the ring')
+        self.auto_replicate = auto_replicate
+        self.write_commands = write_commands
         self.local = local
         self.remote = remote or []
         self.retries = retries
         self.log = log or logging
-        self.pool = GreenPool(pool_size) if pool_size else GreenPool()
+        self.backend = _backends[backend](pool_size)
+        self.encode_once = encode_once
+        self.coalesce = coalesce
+        self.stats_hooks = stats_hooks or []
+        self.host_stats = {}
         self.wait_for_remote = wait_for_remote
+        self.min_remote_acks = min_remote_acks
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.adaptive_batching = adaptive_batching
+        self.max_batch_size = max_batch_size
+        self.windows = {}
+        self.queue_size = queue_size
+        self.queue_workers = queue_workers
+        self.overflow = overflow
+        self.spill_dir = spill_dir
+        self.key_filters = dict((host, _key_filter(spec))
+                                for host, spec in (key_filters or {}).items())
+        unknown = set(self.key_filters) | set(rate_limits or ())
+        unknown -= set(self._host(server) for server in self.remote)
+        if unknown:
+            raise ValueError('Unknown hosts: '+', '.join(unknown))
+        for limits in (rate_limits or {}).values():
+            if set(limits) - set(['ops', 'bytes']):
+                raise ValueError('Rate limits must be ops or bytes')
+        self.rate_limits = dict(
+            (host, dict((unit, _TokenBucket(rate, self.backend.lock()))
+                        for unit, rate in limits.items()))
+            for host, limits in (rate_limits or {}).items())
+        self.shard_backend = None
+        if any(isinstance(server, ShardedRedis) for server in self.remote):
+            self.shard_backend = _backends[backend](None)
+        self.lanes = dict((lane, _backends[backend](size))
+                          for lane, size in (lanes or {}).items())
+        self.queues = None
+        self.lane_queues = {}
+        if batch_size or queue_size:
+            self.queues = self._queues(self.backend)
+            self.lane_queues = dict((lane, self._queues(lane_backend))
+                                    for lane, lane_backend
+                                    in self.lanes.items())
+        self.retry_backoff = retry_backoff
+        self.breaker_threshold = breaker_threshold
+        self.breaker_timeout = breaker_timeout
+        self.breakers = None
+        if breaker_threshold:
+            self.breakers = dict((id(server), _CircuitBreaker(self, server))
+                                 for server in self.remote)
+        self.journal_interval = journal_interval
+        self.journals = None
+        if journal_dir:
+            self.journals = {}
+            for server in self.remote:
+                path = os.path.join(journal_dir,
+                                    self._journal_name(server))
+                journal = _Journal(path, self.backend.lock())
+                self.journals[id(server)] = journal
+                if journal and journal.start_replay():
+                    self.backend.background(self._replay, server, journal)
+        self.sequence = itertools.count(1)
+        self.sequence_lock = self.backend.lock()
+        self.watermarks = dict((self._host(server),
+                                _Watermark(self.backend.lock()))
+                               for server in self.remote)
+        self.ring_interval = ring_interval
+        self.ring = None
+        if ring_path:
+            self.ring = _Ring(ring_path, ring_size, self.backend.lock())
+        self.scripts = {}
+        self.loaded_scripts = {}
+        self.warmup_connections = warmup_connections
+        self.keepalive_interval = keepalive_interval
+        #: The hosts that could not be reached by ``warmup``.
+        self.unreachable = []
+        self.closed = False
+        if warmup:
+            self._warmup()
+        if keepalive_interval:
+            for server in self._servers():
+                self.backend.background(self._keepalive, server)
 
     def __getattr__(self, name):
         """Regular methods on this object will be redirected to the local redis
         object given in the constructor. Methods suffixed with `_everywhere`
-        will be performed everywhere.
+        will be performed everywhere, as will methods named in
+        ``write_commands`` when ``auto_replicate`` is enabled. Keyword
+        arguments of those are passed to the command, except for those of
+        :meth:`run_everywhere`. The resulting method is remembered, so that
+        later calls do not come back here.
 
         :param name: The method name passed to the local instance.
 
         """
         if name.endswith('_everywhere'):
-            name, everywhere = name.rsplit('_', 1)
-            getattr(self.local, name)   # Check the command exists.
-            def intercept(*args):
-                return self.run_everywhere(name, args)
-            return intercept
+            method = self._intercept(name[:-len('_everywhere')])
+        elif self.auto_replicate and name in self.write_commands:
+            method = self._intercept(name)
         else:
-            return getattr(self.local, name)
+            method = getattr(self.local, name)
+            if not callable(method):
+                return method
+        self.__dict__[name] = method
+        return method
+
+    def _intercept(self, command):
+        getattr(self.local, command)   # Check the command exists.
+        def intercept(*args, **kwargs):
+            options = dict((name, kwargs.pop(name)) for name in _options
+                           if name in kwargs)
+            return self.run_everywhere(command,
+                                       _positional(command, args, kwargs),
+                                       **options)
+        return intercept
+
+    def _servers(self):
+        # Returns the local connection, if any, and the remote connections.
+        return [self.local] * (self.local is not None) + self.remote
+
+    def _queues(self, backend):
+        return dict((id(server), _RemoteQueue(self, server, backend))
+                    for server in self.remote)
+
+    def _lane(self, lane):
+        # Returns the backend and remote queues of a priority lane.
+        if lane is None:
+            return self.backend, self.queues
+        if lane not in self.lanes:
+            raise ValueError('Unknown lane: '+lane)
+        return self.lanes[lane], self.lane_queues.get(lane)
 
-    def _wait_pile(self, pile):
-        # Waits on a GreenPile to finish while ignoring thrown exceptions.
+    def _host(self, conn):
+        # Connections are kept apart by "host:port" in replication, stats,
+        # lag and filters.
+        if isinstance(conn, ShardedRedis):
+            return conn.name
+        return _address(conn) or '[Unknown]'
+
+    def _host_name(self, conn):
+        # Returns the host name used in log messages and exceptions.
+        try:
+            return conn.connection_pool.connection_kwargs['host']
+        except (AttributeError, KeyError):
+            return self._host(conn)
+
+    def _ping(self, conn):
+        # Sends a PING on each of several pooled connections at once, so that
+        # they are all opened and used.
+        if isinstance(conn, ShardedRedis):
+            for shard in conn.shards:
+                self._ping(shard)
+            return
+        pool = conn.connection_pool
+        connections = []
+        try:
+            for i in range(self.warmup_connections):
+                connection = pool.get_connection('PING')
+                connections.append(connection)
+                connection.send_command('PING')
+            for connection in connections:
+                connection.read_response()
+        except redis.RedisError:
+            for connection in connections:
+                connection.disconnect()
+            raise
+        finally:
+            for connection in connections:
+                pool.release(connection)
+
+    def _warmup(self):
+        servers = self._servers()
+        threads = [self.backend.spawn(self._ping, server)
+                   for server in servers]
+        for server, thread in zip(servers, threads):
+            try:
+                thread.wait()
+            except redis.RedisError:
+                host = self._host(server)
+                self.log.warn('Could not reach '+host+' during warmup')
+                self.unreachable.append(host)
+
+    def _keepalive(self, conn):
         while True:
+            self.backend.sleep(self.keepalive_interval)
+            if self.closed:
+                return
             try:
-                pile.next()
-            except StopIteration:
-                break
+                self._ping(conn)
+            except redis.RedisError:
+                self.log.debug('Keepalive failed for '+self._host(conn))
+
+    def _journal_name(self, conn):
+        return '%s.journal' % self._host(conn).replace(':', '-')
+
+    def _journal(self, conn, commands):
+        # Saves commands for later replay on a remote client.
+        journal = self.journals[id(conn)]
+        journal.append(commands)
+        if journal.start_replay():
+            self.backend.background(self._replay, conn, journal)
+
+    def _replay(self, conn, journal):
+        # Sends journaled commands to a remote client, in order, once it is
+        # reachable again.
+        while True:
+            self.backend.sleep(self.journal_interval)
+            if self.closed:
+                journal.release()
+                return
+            try:
+                if not journal.claim():
+                    continue   # Another process is replaying it.
+                conn.ping()
+                self._replay_entries(conn, journal)
+            except redis.ConnectionError:
+                continue
+            except Exception:
+                self.log.exception('Unhandled Exception')
+                continue
+            if journal.stop_replay():
+                return
+
+    def _replay_entries(self, conn, journal):
+        while journal and not self.closed:
+            limit = self._limits(conn, self.batch_size or 100, 1)[0]
+            commands, entries, pos, skipped = journal.read(limit)
+            if skipped:
+                self.log.error('Skipped %d unreadable journal entries for %s'
+                               % (skipped, self._host(conn)))
+            if self.coalesce:
+                commands = _coalesce(commands)
+            try:
+                if commands:
+                    self._throttle(conn, commands)
+                    self._attempt(conn, self._pipe_exec, commands)
             except TooManyRetries, e:
                 self.log.error(e.message)
+                return
             except Exception:
                 self.log.exception('Unhandled Exception')
+            journal.ack(entries, pos)
+
+    def _replicate(self, conn, executor, data, commands, replications,
+                   deadline=None):
+        # Runs an operation on a remote client, logging and ignoring thrown
+        # exceptions, and marks it finished for every waiting call.
+        journal = self.journals and self.journals[id(conn)]
+        breaker = self.breakers and self.breakers[id(conn)]
+        ok = False
+        try:
+            if journal or (breaker and not breaker.allow()):
+                if journal is not None:
+                    self._journal(conn, commands)
+            else:
+                self._throttle(conn, commands)
+                self._attempt(conn, executor, data, deadline)
+                ok = True
+                if breaker:
+                    breaker.success()
+        except DeadlineExceeded, e:
+            self.log.warn(e.message)
+            if journal is not None:
+                self._journal(conn, getattr(e, 'commands', commands))
+        except TooManyRetries, e:
+            self.log.error(e.message)
+            if breaker:
+                breaker.failure()
+            if journal is not None:
+                self._journal(conn, getattr(e, 'commands', commands))
+        except Exception:
+            self.log.exception('Unhandled Exception')
+        finally:
+            for replication in replications:
+                replication.finish(ok, self._host(conn))
+
+    def _throttle(self, conn, commands):
+        # Waits until the rate limits of a remote client allow the commands.
+        buckets = self.rate_limits.get(self._host(conn))
+        if buckets:
+            amounts = {'ops': len(commands)}
+            if 'bytes' in buckets:
+                amounts['bytes'] = _command_size(commands)
+            delay = max(bucket.take(amounts[unit])
+                        for unit, bucket in buckets.items())
+            if delay:
+                self.backend.sleep(delay)
 
     def _simple_exec(self, conn, command):
         # Executor that runs a single command.
         op, args = command
+        if op == 'evalsha':
+            return self._evalsha(conn, args)
         return getattr(conn, op)(*args)
 
+    def _load_script(self, conn, sha):
+        # Loads a registered script on a client, unless it is known to be
+        # loaded there already.
+        loaded = self.loaded_scripts.setdefault(id(conn), set())
+        if sha in self.scripts and sha not in loaded:
+            conn.script_load(self.scripts[sha])
+            loaded.add(sha)
+
+    def _evalsha(self, conn, args):
+        # Runs a registered script, reloading it once if the client has lost
+        # it, for example after a restart.
+        sha = args[0]
+        self._load_script(conn, sha)
+        try:
+            return conn.evalsha(*args)
+        except redis.exceptions.NoScriptError:
+            if sha not in self.scripts:
+                raise
+            self.loaded_scripts[id(conn)].discard(sha)
+            self._load_script(conn, sha)
+            return conn.evalsha(*args)
+
+    def _packed_exec(self, conn, command):
+        # Executor that sends a command already encoded by _pack. Sharded
+        # clients route the command themselves, so it is sent unencoded.
+        op, name, packed, options, original = command
+        if isinstance(conn, ShardedRedis):
+            return self._simple_exec(conn, original)
+        pool = conn.connection_pool
+        connection = pool.get_connection(name, **options)
+        try:
+            connection.send_packed_command(packed)
+            return conn.parse_response(connection, name, **options)
+        except redis.ConnectionError:
+            connection.disconnect()
+            raise
+        finally:
+            pool.release(connection)
+
+    def _pack(self, command):
+        # Encodes a command once, so the same buffers are written to every
+        # connection. Returns None for methods that cannot be encoded alone.
+        op, args = command
+        if op == 'evalsha':
+            return None   # Scripts may need reloading, see _evalsha.
+        recorder = _CommandRecorder()
+        try:
+            getattr(type(self.local), op).__func__(recorder, *args)
+        except AttributeError:
+            return None
+        if recorder.command is None:
+            return None
+        args, options = recorder.command
+        pool = self.local.connection_pool
+        connection = pool.get_connection(args[0], **options)
+        try:
+            packed = connection.pack_command(*args)
+        finally:
+            pool.release(connection)
+        return op, args[0], packed, options, command
+
     def _pipe_exec(self, conn, commands):
-        # Executor that pipelines commands.
+        # Executor that pipelines commands. Registered scripts the client has
+        # lost, for example after a restart, are loaded again and only their
+        # calls are sent once more, so no other command runs twice.
+        for op, args in commands:
+            if op == 'evalsha':
+                self._load_script(conn, args[0])
+        results = self._pipeline(conn, commands)
+        lost = [i for i, (op, args) in enumerate(commands)
+                if op == 'evalsha' and args[0] in self.scripts and
+                isinstance(results[i], redis.exceptions.NoScriptError)]
+        if lost:
+            self.loaded_scripts.pop(id(conn), None)
+            for i in lost:
+                self._load_script(conn, commands[i][1][0])
+            retried = self._pipeline(conn, [commands[i] for i in lost])
+            for i, result in zip(lost, retried):
+                results[i] = result
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+    def _pipeline(self, conn, commands):
+        # Sends commands in a pipeline, returning errors among the results.
         pipe = conn.pipeline()
         for op, args in commands:
             getattr(pipe, op)(*args)
-        return pipe.execute()
+        return pipe.execute(raise_on_error=False)
+
+    def _executor(self, commands):
+        # Returns the executor and its data for a list of commands.
+        if len(commands) == 1:
+            return self._simple_exec, commands[0]
+        return self._pipe_exec, commands
+
+    def _sharded_pipe_exec(self, conn, commands, deadline=None):
+        # Splits a pipeline by shard, attempts the parts in parallel and puts
+        # their results back in order, summing those of a delete or mset
+        # split across shards. Each part is retried on its own, and an error
+        # carries the commands with a part that failed.
+        groups = {}
+        for i, (op, args) in enumerate(commands):
+            for index, part in conn.split(op, args):
+                groups.setdefault(index, []).append((i, (op, part)))
+        threads = [(parts, self.shard_backend.spawn(
+                        self._attempt, conn.shards[index], self._pipe_exec,
+                        [command for i, command in parts], deadline))
+                   for index, parts in groups.items()]
+        results = [[] for command in commands]
+        error, failed = None, set()
+        for parts, thread in threads:
+            try:
+                for (i, command), result in zip(parts, thread.wait()):
+                    results[i].append(result)
+            except redis.RedisError, e:
+                error = error or e
+                failed.update(i for i, command in parts)
+        if error is not None:
+            error.commands = [commands[i] for i in sorted(failed)]
+            raise error
+        return [sum(result) if op == 'delete' else
+                all(result) if op == 'mset' else result[0]
+                for (op, args), result in zip(commands, results)]
+
+    def _attempt_sharded(self, conn, commands, deadline=None):
+        # Sends a pipeline to a sharded client, adapting the window of the
+        # group to how long its slowest shard took.
+        start = time.time()
+        try:
+            results = self._sharded_pipe_exec(conn, commands, deadline)
+        except redis.ConnectionError:
+            if self.adaptive_batching:
+                self._window(self._host(conn)).failure()
+            raise
+        if self.adaptive_batching:
+            self._window(self._host(conn)).update(len(commands),
+                                                  time.time() - start)
+        return results
+
+    def _start(self, executor, data, commands, deadline=None, lane=None):
+        # Starts an operation locally and on remote clients, returning the
+        # local GreenThread and the replication to the remote clients.
+        backend, queues = self._lane(lane)
+        plan = self._plan(executor, data, commands)
+        replication = self._replication()
+        ret = backend.spawn(self._attempt, self.local, executor, data,
+                            deadline)
+        if self.ring is not None:
+            self._push(commands)
+        self._fan_out(backend, queues, replication, plan, deadline)
+        return ret, replication
 
-    def _run_all(self, executor, data):
+    def _replication(self):
+        # Numbers a new write to the remote clients, and starts tracking it.
+        with self.sequence_lock:
+            seq = next(self.sequence)
+            for watermark in self.watermarks.values():
+                watermark.start(seq)
+        return _Replication(self.backend,
+                            [self._host(server) for server in self.remote],
+                            seq, self.watermarks)
+
+    def _push(self, commands):
+        # Hands commands to the replicator process through the ring.
+        while not self.ring.append(commands):
+            if self.overflow != 'block':
+                self.log.warn('Dropped commands for the full replication ring')
+                return
+            self.backend.sleep(self.ring_interval)
+
+    def _plan(self, executor, data, commands):
+        # Applies the key filters, returning the executor, data and commands
+        # for each remote client, with no commands for clients that want
+        # none of them.
+        plan = []
+        for server in self.remote:
+            server_executor, server_data = executor, data
+            server_commands = commands
+            key_filter = self.key_filters.get(self._host(server))
+            if key_filter is not None:
+                server_commands = [(op, args) for op, args in commands
+                                   if _command_key(op, args) is None or
+                                   key_filter(_command_key(op, args))]
+                if server_commands and \
+                        len(server_commands) < len(commands):
+                    server_executor, server_data = \
+                        self._executor(server_commands)
+            plan.append((server, server_executor, server_data,
+                         server_commands))
+        return plan
+
+    def _fan_out(self, backend, queues, replication, plan, deadline=None):
+        # Sends an operation to every remote client that wants it.
+        for server, server_executor, server_data, server_commands in plan:
+            if not server_commands:
+                replication.finish(True, self._host(server))
+                continue
+            if queues:
+                queues[id(server)].put(server_commands, replication)
+            else:
+                backend.spawn(self._replicate, server, server_executor,
+                              server_data, server_commands, [replication],
+                              deadline)
+
+    def _stream(self, commands, chunk_size, depth, lane):
+        # Pipelines chunks of commands everywhere, yielding the local results
+        # of each chunk once it has finished on every client. Chunks in flight
+        # together run on different connections, so each client may apply
+        # them in any order; a chunk sharing keys with one in flight waits
+        # for it to finish everywhere first.
+        commands = iter(commands)
+        in_flight = deque()
+        while True:
+            size, window = self._limits(self.local, 1000, 2)
+            while len(in_flight) >= (depth or window):
+                yield self._finish_chunk(in_flight.popleft())
+            chunk = list(itertools.islice(commands, chunk_size or size))
+            keys = _chunk_keys(chunk)
+            while in_flight and (not chunk or any(
+                    keys is None or other is None or keys & other
+                    for ret, replication, other in in_flight)):
+                yield self._finish_chunk(in_flight.popleft())
+            if not chunk:
+                return
+            ret, replication = self._start(self._pipe_exec, chunk, chunk,
+                                           lane=lane)
+            in_flight.append((ret, replication, keys))
+
+    def _finish_chunk(self, chunk):
+        # Waits for a chunk of a stream everywhere, returning its local
+        # results.
+        ret, replication, keys = chunk
+        try:
+            return self.backend.wait(ret)
+        except TooManyRetries, e:
+            self.log.error(e.message)
+            raise
+        finally:
+            replication.wait()
+
+    def _run_all(self, executor, data, commands, min_remote_acks=None,
+                 timeout=None, lane=None, token=False):
         # Performs an operation locally and then mimics it on remote clients.
         # This function only returns data for the local instance, but will
         # wait for all remote instances to finish (and ignores their success or
-        # failure).
-        if not self.remote:
-            return self._attempt(self.local, executor, data)
-        pile = GreenPile(self.pool)
-        ret = self.pool.spawn(self._attempt, self.local, executor, data)
-        for server in self.remote:
-            pile.spawn(self._attempt, server, executor, data)
+        # failure). When the timeout expires, anything still running is left
+        # to finish in the background.
+        if token and self.ring is not None:
+            raise ValueError('Writes put in the ring cannot be waited for')
+        if min_remote_acks is None:
+            min_remote_acks = self.min_remote_acks
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        if not self.remote and not min_remote_acks and deadline is None and \
+                self.ring is None:
+            result = self._attempt(self.local, executor, data)
+            if token:
+                return result, _Replication(self.backend, [])
+            return result
+        ret, replication = self._start(executor, data, commands, deadline,
+                                       lane)
         try:
-            return ret.wait()
+            result = self.backend.wait(ret, _remaining(deadline))
         except TooManyRetries, e:
             self.log.error(e.message)
             raise
         finally:
             if self.wait_for_remote:
-                self._wait_pile(pile)
-            else:
-                self.pool.spawn(self._wait_pile, pile)
+                done = replication.wait(None, _remaining(deadline))
+        if self.wait_for_remote and not done:
+            raise DeadlineExceeded('Deadline exceeded waiting for remote '
+                                   'writes', result=result)
+        if min_remote_acks:
+            if not replication.wait(min_remote_acks, _remaining(deadline)):
+                raise DeadlineExceeded('Deadline exceeded waiting for remote '
+                                       'writes', result=result)
+            if replication.acks < min_remote_acks:
+                raise QuorumNotReached(replication.acks, min_remote_acks,
+                                       result)
+        if token:
+            return result, replication
+        return result
+
+    def _count(self, stats, host, command, metric):
+        stats.counts[metric] += 1
+        self._hook(host, command, metric, 1)
+
+    def _hook(self, host, command, metric, value):
+        # Calls the stats hooks, logging their exceptions rather than letting
+        # them fail the operation being measured.
+        for hook in self.stats_hooks:
+            try:
+                hook(host, command, metric, value)
+            except Exception:
+                self.log.exception('Exception in stats hook')
+
+    def _window(self, host):
+        window = self.windows.get(host)
+        if window is None:
+            window = _Window(self.batch_size or 100, self.max_batch_size)
+            window = self.windows.setdefault(host, window)
+        return window
+
+    def _limits(self, conn, size, depth):
+        # Returns the pipeline size and number of pipelines in flight to use
+        # for a connection, adapted to it when adaptive batching.
+        if self.adaptive_batching:
+            window = self._window(self._host(conn))
+            return window.size, window.depth
+        return size, depth
 
-    def _attempt(self, conn, executor, data):
+    def _attempt(self, conn, executor, data, deadline=None):
         # This method is run for each redis connection in its own GreenThread.
-        try:
-            host = conn.connection_pool.connection_kwargs['host']
-        except (AttributeError, KeyError):
-            host = '[Unknown]'
+        if isinstance(conn, ShardedRedis) and executor == self._pipe_exec:
+            return self._attempt_sharded(conn, data, deadline)
+        host, name = self._host(conn), self._host_name(conn)
+        stats = self.host_stats.get(host)
+        if stats is None:
+            stats = self.host_stats.setdefault(host, _HostStats())
+        if data and isinstance(data[0], basestring):
+            command = data[0]
+        else:
+            command = 'pipeline'
         last_connection_error = None
         for i in range(self.retries):
+            if deadline is not None and time.time() >= deadline:
+                raise DeadlineExceeded('Deadline exceeded with '+name, name,
+                                       address=host)
+            if i:
+                self._count(stats, host, command, 'retries')
+            self._count(stats, host, command, 'sent')
+            start = time.time()
             try:
-                return executor(conn, data)
+                ret = executor(conn, data)
             except redis.ConnectionError, e:
-                self.log.warn('Connectivity issue with '+host)
+                self.log.warn('Connectivity issue with '+name)
                 last_connection_error = e
+                self.loaded_scripts.pop(id(conn), None)
+                if self.adaptive_batching:
+                    self._window(host).failure()
+                if self.retry_backoff and i + 1 < self.retries:
+                    delay = random.uniform(0, self.retry_backoff * (2 ** i))
+                    if deadline is not None:
+                        delay = min(delay, _remaining(deadline))
+                    self.backend.sleep(delay)
             except redis.RedisError, e:
-                self.log.exception('Redis exception with '+host)
-                greenthread.sleep(0)
+                self._count(stats, host, command, 'errors')
+                self.log.exception('Redis exception with '+name)
+                self.backend.sleep(0)
                 raise e
-        greenthread.sleep(0)
-        raise TooManyRetries(last_connection_error, host)
+            else:
+                elapsed = time.time() - start
+                if self.adaptive_batching and command == 'pipeline':
+                    self._window(host).update(len(data), elapsed)
+                stats.observe(command, elapsed)
+                self._count(stats, host, command, 'successes')
+                self._hook(host, command, 'latency', elapsed)
+                return ret
+        self._count(stats, host, command, 'too_many_retries')
+        self.backend.sleep(0)
+        raise TooManyRetries(last_connection_error, name, host)
 
-    def run_everywhere(self, command, args):
+    def run_everywhere(self, command, args, min_remote_acks=None,
+                       timeout=None, lane=None, token=False):
         """Runs the command with the given args on the local instance and all
         remote redis instances. This operation is not atomic. The return value
         and/or exception thrown will only come from the local instance, but the
@@ -168,14 +2028,61 @@ class RedisMultiWrite(object):
         :param command: The command to run, as it would be given as a method to
                         the python redis library, e.g. 'delete' or 'expire'.
         :param args: Tuple of arguments to pass in to the method.
+        :param min_remote_acks: Overrides the ``min_remote_acks`` given to the
+                                constructor for this call.
+        :param timeout: If given, the number of seconds this call may take,
+                        including retries and any waiting on remote
+                        instances. Operations still running when it expires
+                        continue in the background, but are not retried.
+        :param lane: The name of the priority lane to run in, from the
+                     ``lanes`` given to the constructor. Default: the shared
+                     pool and queues.
+        :param token: If True, a replication token is returned along with
+                      the result, to be given to :meth:`wait_replicated`
+                      when the caller needs the write to have reached the
+                      remote instances.
 
-        :returns: The return value from the local instance execution.
-        :raises: :exc:`TooManyRetries`
+        :returns: The return value from the local instance execution, or a
+                  tuple of it and the replication token.
+        :raises: :exc:`TooManyRetries`, :exc:`QuorumNotReached`,
+                 :exc:`DeadlineExceeded`
 
         """
-        return self._run_all(self._simple_exec, (command, args))
+        command = (command, args)
+        executor, data = self._simple_exec, command
+        if self.encode_once and self.remote:
+            packed = self._pack(command)
+            if packed:
+                executor, data = self._packed_exec, packed
+        return self._run_all(executor, data, [command], min_remote_acks,
+                             timeout, lane, token)
+
+    def register_script(self, script):
+        """Registers a Lua script to be run everywhere by its SHA1 digest with
+        ``evalsha_everywhere()``, so that the script itself is not sent with
+        every call. It is loaded with ``SCRIPT LOAD`` on every instance now,
+        and loaded again wherever it is missing later, such as after a
+        restart, without counting as a retry.
+
+        :param script: The Lua source of the script.
+
+        :returns: The SHA1 digest to pass to ``evalsha_everywhere()``.
+
+        """
+        sha = hashlib.sha1(script).hexdigest()
+        self.scripts[sha] = script
+        servers = self._servers()
+        threads = [self.backend.spawn(self._load_script, server, sha)
+                   for server in servers]
+        for server, thread in zip(servers, threads):
+            try:
+                thread.wait()
+            except redis.RedisError:
+                self.log.warn('Could not load script on '+self._host(server))
+        return sha
 
-    def pipeline_everywhere(self, zipped_commands):
+    def pipeline_everywhere(self, zipped_commands, min_remote_acks=None,
+                            timeout=None, lane=None, token=False):
         """Runs the :meth:`~eventlet.StrictRedis.pipeline` function of the
         python redis library on the local instance and all remote redis
         instances. The operations are atomic to each instance, but the
@@ -185,11 +2092,412 @@ class RedisMultiWrite(object):
 
         :param zipped_commands: List of tuples (command, args) to construct a
                                 pipeline of commands with.
+        :param min_remote_acks: Overrides the ``min_remote_acks`` given to the
+                                constructor for this call.
+        :param timeout: If given, the number of seconds this call may take, as
+                        with :meth:`run_everywhere`.
+        :param lane: The priority lane to run in, as with
+                     :meth:`run_everywhere`.
+        :param token: If True, a replication token is returned along with
+                      the results, as with :meth:`run_everywhere`.
 
         :returns: The results of the :meth:`~eventlet.StrictRedis.pipeline` on
-                  the local instance.
+                  the local instance, or a tuple of them and the replication
+                  token.
+        :raises: :exc:`TooManyRetries`, :exc:`QuorumNotReached`,
+                 :exc:`DeadlineExceeded`
+
+        """
+        return self._run_all(self._pipe_exec, zipped_commands, zipped_commands,
+                             min_remote_acks, timeout, lane, token)
+
+    def wait_replicated(self, token, hosts=None, timeout=None):
+        """Waits until the call that returned a replication token has
+        finished on remote instances, so that callers may write at local
+        latency and only wait where they need their writes to be visible
+        elsewhere.
+
+        :param token: The token returned by a call given ``token=True``.
+        :param hosts: The ``host:port`` names of the remote instances to wait
+                      for.
+                      Default: every remote instance.
+        :param timeout: If given, the number of seconds to wait.
+
+        :returns: True if the call succeeded on every one of the hosts,
+                  False if it failed on any of them.
+        :raises: :exc:`DeadlineExceeded`
+
+        """
+        hosts = token.hosts if hosts is None else frozenset(hosts)
+        if not hosts <= token.hosts:
+            raise ValueError('Unknown hosts: '+', '.join(hosts - token.hosts))
+        if not token.wait(None, timeout, hosts):
+            raise DeadlineExceeded('Deadline exceeded waiting for remote '
+                                   'writes')
+        return hosts <= token.acked
+
+    def stream_everywhere(self, commands, chunk_size=None, depth=None,
+                          results=False, lane=None):
+        """Like :meth:`pipeline_everywhere`, but for bulk loads of any size.
+        The commands are read from any iterable, such as a generator, and sent
+        to every instance in pipelines of ``chunk_size`` commands. Up to
+        ``depth`` chunks are in flight at once, and no more are read until the
+        oldest has finished on every instance, so memory use stays flat
+        regardless of the number of commands. Each chunk is atomic to each
+        instance, but the stream as a whole is not. Chunks in flight together
+        may be applied in a different order on each instance, so a chunk is
+        only sent once every chunk in flight sharing a key with it (or whose
+        keys cannot be told, such as one with ``mset``) has finished.
+
+        :param commands: Iterable of tuples (command, args).
+        :param chunk_size: The number of commands in each pipeline. Defaults
+                           to 1000, or adapts to the local connection when
+                           ``adaptive_batching`` is enabled.
+        :param depth: The number of chunks in flight at once. Defaults to 2,
+                      or adapts like ``chunk_size``.
+        :param results: If True, returns an iterator of the local results of
+                        each command instead. Nothing is sent until it is
+                        iterated.
+        :param lane: The priority lane to run in, as with
+                     :meth:`run_everywhere`.
+
+        :returns: The number of commands performed.
         :raises: :exc:`TooManyRetries`
 
         """
-        return self._run_all(self._pipe_exec, zipped_commands)
+        chunks = self._stream(commands, chunk_size, depth, lane)
+        if results:
+            return itertools.chain.from_iterable(chunks)
+        return sum(len(chunk) for chunk in chunks)
+
+    def replicate_ring(self, ring_path, ring_size=64*1024*1024):
+        """Drains the ring buffer filled by the processes given ``ring_path``,
+        sending its commands to the remote instances of this object in
+        pipelines of up to ``batch_size`` (or 1000) commands. Each pipeline
+        is sent the same way as any other call, using the queues, journals,
+        circuit breakers and key filters configured here. This method only
+        returns once :meth:`close` is called, and is meant to be the work of
+        a dedicated replicator process, whose ``local`` may be None.
+
+        :param ring_path: The shared memory file of the ring buffer.
+        :param ring_size: The number of bytes in the ring buffer, if it has
+                          not been created yet.
+
+        """
+        ring = _Ring(ring_path, ring_size, self.backend.lock())
+        while not self.closed:
+            commands, pos = ring.read(self.batch_size or 1000)
+            if not commands:
+                self.backend.sleep(self.ring_interval)
+                continue
+            if self.coalesce:
+                commands = _coalesce(commands)
+            executor, data = self._executor(commands)
+            plan = self._plan(executor, data, commands)
+            replication = self._replication()
+            self._fan_out(self.backend, self.queues, replication, plan)
+            replication.wait()
+            ring.ack(pos)
+
+    def stats(self):
+        """Returns the counters and latency histograms kept for each host.
+        The counters are ``sent`` (including retries), ``successes``,
+        ``retries``, ``too_many_retries`` and ``errors`` (redis errors other
+        than connectivity issues). The ``latency`` entry maps each command
+        name, or ``'pipeline'``, to a list of (upper bound in seconds, count)
+        pairs for its successful operations. With ``adaptive_batching``, the
+        ``window`` entry holds the current pipeline ``size`` and ``depth`` of
+        pipelines in flight. With ``rate_limits``, the ``rate`` entry holds
+        the utilization of the ``ops`` and ``bytes`` limits: zero when idle,
+        about one at the limit, and above one when work is waiting.
+
+        :returns: Dictionary of ``host:port`` names to their statistics.
+
+        """
+        stats = dict((host, stats.snapshot())
+                     for host, stats in self.host_stats.items())
+        for host, window in self.windows.items():
+            stats.setdefault(host, {})['window'] = {'size': window.size,
+                                                    'depth': window.depth}
+        for host, buckets in self.rate_limits.items():
+            stats.setdefault(host, {})['rate'] = dict(
+                (unit, bucket.utilization())
+                for unit, bucket in buckets.items())
+        return stats
+
+    def lag(self):
+        """Returns how far behind each remote connection is. Every call sent
+        to the remote connections is numbered in sequence, also available as
+        the ``seq`` attribute of its replication token. For each host,
+        ``finished`` is the highest number up to which every call has
+        finished, ``in_flight`` is the number of calls still running or
+        queued, and ``oldest_age`` is the number of seconds the oldest of
+        them has been waiting. Calls that gave up, were dropped or were
+        skipped by the circuit breaker count as finished, but are also
+        counted by ``failed``, and ``last_failure_age`` is the number of
+        seconds since the latest of them (or None). A remote that is down
+        thus shows ``failed`` growing and ``last_failure_age`` staying low.
+        Calls skipped by ``key_filters`` count as succeeded. With
+        ``journal_dir``, ``journaled`` is the number of calls waiting in the
+        journal.
+
+        :returns: Dictionary of ``host:port`` names to their replication lag.
+
+        """
+        lag = dict((host, watermark.snapshot())
+                   for host, watermark in self.watermarks.items())
+        if self.journals:
+            for server in self.remote:
+                lag[self._host(server)]['journaled'] = \
+                    len(self.journals[id(server)])
+        return lag
+
+    def queue_depth(self, lane=None):
+        """Returns the number of calls waiting to be sent to each remote
+        connection, including any spilled to disk. Calls are only queued when
+        ``batch_size`` or ``queue_size`` was given.
+
+        :param lane: The priority lane whose queues to count. Default: the
+                     shared queues.
+
+        :returns: Dictionary of ``host:port`` names to queue depths.
+
+        """
+        queues = self._lane(lane)[1]
+        return dict((self._host(server),
+                     len(queues[id(server)]) if queues else 0)
+                    for server in self.remote)
+
+    def close(self):
+        """Stops the background work of this object: keepalive pings,
+        journal replay, :meth:`replicate_ring` and the workers of remote
+        queues. Sleeping loops stop when they next wake up, and queue workers
+        once the calls queued before this one have been sent. Journals keep
+        their unsent commands for the next process.
+
+        """
+        self.closed = True
+        for queues in [self.queues] + self.lane_queues.values():
+            for queue in (queues or {}).values():
+                queue.close()
+
+
+class KeyspaceSync(object):
+    """Brings the remote redis instances of a :class:`RedisMultiWrite` back in
+    line with its local instance, which is taken to be authoritative. Keys are
+    divided into ranges by hash, and each range is compared by a digest of its
+    keys, values and TTLs computed on the server with a Lua script, so only
+    key names and digests cross the network. Ranges that differ are divided
+    again until they are small enough to compare key by key, and the keys
+    that differ are copied from the local instance or deleted from the remote
+    one in pipelines. Values are compared using ``DUMP``, so every instance
+    should run the same redis version. A :class:`ShardedRedis` is scanned
+    shard by shard, and its keys are digested on the shards owning them.
+    Only the keys passing the ``key_filters`` of a remote instance are
+    compared with it.
+
+    The key names of the local instance, and of the remote instance being
+    compared, are held in memory for the whole comparison, since ``SCAN``
+    cannot select keys by hash. Allow for about a hundred bytes per key on
+    each side, or run the sync against a replica on a host with room.
+
+    :param rmw: The :class:`RedisMultiWrite` whose connections to sync.
+    :param fanout: The number of ranges each differing range is divided into,
+                   at least 2.
+    :param leaf_size: Ranges with at most this many keys are compared key by
+                      key.
+    :param batch_size: The number of keys per ``SCAN``, digest script and
+                       repair pipeline.
+    :param ttl_granularity: TTLs are compared in units of this many seconds,
+                            since they count down between reads.
+    :param throttle: The number of seconds to pause between requests, to
+                     limit the load on production instances.
+    :param dry_run: If True, differences are counted but not repaired.
+
+    """
+
+    digest_script = """
+local digests = {}
+for i, key in ipairs(KEYS) do
+    local dump = redis.call('DUMP', key)
+    if dump then
+        local ttl = redis.call('PTTL', key)
+        if ttl > 0 then
+            ttl = math.floor(ttl / 1000 / tonumber(ARGV[1]))
+        end
+        digests[i] = redis.sha1hex(key .. '\\0' .. dump .. '\\0' .. ttl)
+    else
+        digests[i] = ''
+    end
+end
+if ARGV[2] == 'keys' then
+    return digests
+end
+return redis.sha1hex(table.concat(digests))
+"""
+
+    def __init__(self, rmw, fanout=16, leaf_size=100, batch_size=100,
+                 ttl_granularity=60, throttle=0.0, dry_run=False):
+        if fanout < 2:
+            raise ValueError('fanout must be at least 2')
+        self.rmw = rmw
+        self.fanout = fanout
+        self.leaf_size = leaf_size
+        self.batch_size = batch_size
+        self.ttl_granularity = ttl_granularity
+        self.throttle = throttle
+        self.dry_run = dry_run
+
+    def _pause(self):
+        if self.throttle:
+            self.rmw.backend.sleep(self.throttle)
+
+    def _scan(self, conn):
+        if isinstance(conn, ShardedRedis):
+            return set().union(*[self._scan(shard) for shard in conn.shards])
+        keys, cursor = set(), 0
+        while True:
+            cursor, batch = conn.scan(cursor, count=self.batch_size)
+            keys.update(batch)
+            if not int(cursor):
+                return keys
+            self._pause()
+
+    def _digests(self, conn, keys, per_key=False):
+        # Returns the digest of each key, or a single digest of them all.
+        if isinstance(conn, ShardedRedis):
+            return self._sharded_digests(conn, keys, per_key)
+        digests = []
+        for i in range(0, len(keys), self.batch_size):
+            chunk = keys[i:i+self.batch_size]
+            digests.append(conn.eval(self.digest_script, len(chunk),
+                                     *(chunk + [self.ttl_granularity,
+                                                'keys' if per_key else ''])))
+            self._pause()
+        if per_key:
+            return list(itertools.chain.from_iterable(digests))
+        return hashlib.sha1(''.join(digests)).hexdigest()
+
+    def _sharded_digests(self, conn, keys, per_key):
+        # Digests each key on its own shard, then combines the digests as the
+        # script does, so they compare equal to those of a single instance.
+        groups = {}
+        for i, key in enumerate(keys):
+            groups.setdefault(conn.index(key), []).append(i)
+        digests = [None] * len(keys)
+        for index, indexes in groups.items():
+            shard_keys = [keys[i] for i in indexes]
+            for i, digest in zip(indexes, self._digests(conn.shards[index],
+                                                        shard_keys, True)):
+                digests[i] = digest
+        if per_key:
+            return digests
+        return hashlib.sha1(''.join(
+            hashlib.sha1(''.join(digests[i:i+self.batch_size])).hexdigest()
+            for i in range(0, len(keys), self.batch_size))).hexdigest()
+
+    def _split(self, keys, level):
+        # Each level of ranges uses the next base-fanout digit of the hash.
+        ranges = [set() for i in range(self.fanout)]
+        for key in keys:
+            digest = int(hashlib.md5(key).hexdigest(), 16)
+            ranges[digest // self.fanout ** level % self.fanout].add(key)
+        return ranges
+
+    def _compare(self, remote, local_keys, remote_keys, level, stats):
+        stats['ranges'] += 1
+        if self._digests(self.rmw.local, sorted(local_keys)) == \
+                self._digests(remote, sorted(remote_keys)):
+            return
+        stats['differing'] += 1
+        if len(local_keys | remote_keys) <= self.leaf_size or \
+                self.fanout ** level >= 1 << 128:
+            return self._repair(remote, sorted(local_keys | remote_keys),
+                                stats)
+        local_ranges = self._split(local_keys, level)
+        remote_ranges = self._split(remote_keys, level)
+        for local_range, remote_range in zip(local_ranges, remote_ranges):
+            if local_range or remote_range:
+                self._compare(remote, local_range, remote_range, level + 1,
+                              stats)
+
+    def _repair(self, remote, keys, stats):
+        local_digests = self._digests(self.rmw.local, keys, True)
+        remote_digests = self._digests(remote, keys, True)
+        differing = [(key, bool(digest)) for key, digest, remote_digest
+                     in zip(keys, local_digests, remote_digests)
+                     if digest != remote_digest]
+        for i in range(0, len(differing), self.batch_size):
+            chunk = differing[i:i+self.batch_size]
+            copied = [key for key, exists in chunk if exists]
+            dumps = self.rmw._attempt(self.rmw.local, self.rmw._pipe_exec,
+                                      [(op, (key, )) for key in copied
+                                       for op in ('dump', 'pttl')])
+            commands = []
+            for key, exists in chunk:
+                if not exists:
+                    commands.append(('delete', (key, )))
+                    stats['deleted'] += 1
+            for key, dump, ttl in zip(copied, dumps[::2], dumps[1::2]):
+                if dump is not None:
+                    commands.append(('delete', (key, )))
+                    commands.append(('restore', (key, max(ttl, 0), dump)))
+                    stats['restored'] += 1
+            if commands and not self.dry_run:
+                self.rmw._attempt(remote, self.rmw._pipe_exec, commands)
+            self._pause()
+
+    def sync(self):
+        """Compares each remote instance with the local instance, and repairs
+        the keys that differ.
+
+        :returns: List with a dictionary for each remote instance, in order,
+                  counting the ``ranges`` compared, the ``differing`` ranges,
+                  and the keys ``restored`` and ``deleted`` (or that would be,
+                  in a dry run).
+
+        """
+        local_keys = self._scan(self.rmw.local)
+        results = []
+        for remote in self.rmw.remote:
+            stats = dict.fromkeys(('ranges', 'differing', 'restored',
+                                   'deleted'), 0)
+            remote_keys = self._scan(remote)
+            key_filter = self.rmw.key_filters.get(self.rmw._host(remote))
+            if key_filter is None:
+                self._compare(remote, local_keys, remote_keys, 0, stats)
+            else:
+                self._compare(remote, set(filter(key_filter, local_keys)),
+                              set(filter(key_filter, remote_keys)), 0, stats)
+            results.append(stats)
+        return results
+
 
+def sync_main():
+    """Entry point of the ``redis-multiwrite-sync`` command, which runs a
+    :class:`KeyspaceSync` between the instances given as redis URLs.
+
+    """
+    import json
+    import argparse
+    parser = argparse.ArgumentParser(description='Repairs remote redis '
+                                     'instances that differ from the local '
+                                     'instance.')
+    parser.add_argument('local', help='URL of the local instance')
+    parser.add_argument('remote', nargs='+', help='URLs of remote instances')
+    parser.add_argument('--fanout', type=int, default=16)
+    parser.add_argument('--leaf-size', type=int, default=100)
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--ttl-granularity', type=int, default=60)
+    parser.add_argument('--throttle', type=float, default=0.0,
+                        help='seconds to pause between requests')
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+    if args.fanout < 2:
+        parser.error('--fanout must be at least 2')
+    rmw = RedisMultiWrite(redis.StrictRedis.from_url(args.local),
+                          [redis.StrictRedis.from_url(url)
+                           for url in args.remote], backend='inline')
+    sync = KeyspaceSync(rmw, args.fanout, args.leaf_size, args.batch_size,
+                        args.ttl_granularity, args.throttle, args.dry_run)
+    print json.dumps(dict(zip(args.remote, sync.sync())), sort_keys=True)
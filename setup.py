@@ -30,6 +30,14 @@ setup(name='python-redis-multiwrite',
           'hiredis',
           'eventlet',
       ],
+      extras_require={
+          'threads': ['futures'],
+      },
+      entry_points={
+          'console_scripts': [
+              'redis-multiwrite-sync = redismultiwrite:sync_main',
+          ],
+      },
       classifiers=['Development Status :: 3 - Alpha',
                    'Intended Audience :: Developers',
                    'Intended Audience :: Information Technology',
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+
+"""Benchmarks RedisMultiWrite against in-process stand-in redis servers that
+speak the redis protocol, with configurable latency, jitter and failure rates
+for the remote servers. Each scenario prints one line of JSON.
+
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import itertools
+
+import eventlet
+from eventlet import monkey_patch
+from redis import StrictRedis
+
+# Benchmark the checkout this script lives in, not an installed copy.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from redismultiwrite import RedisMultiWrite
+
+
+class Status(str):
+    pass
+
+
+class StandInRedis(object):
+    """A listening socket that answers a small subset of redis commands. Each
+    network round trip is delayed by ``latency`` plus or minus ``jitter``
+    seconds, and fails by dropping the connection with probability
+    ``failure_rate``.
+
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, failure_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.data = {}
+        self.sock = eventlet.listen(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+        eventlet.spawn_n(self._serve)
+
+    def _serve(self):
+        while True:
+            conn, addr = self.sock.accept()
+            eventlet.spawn_n(self._handle, conn)
+
+    def _parse(self, buf):
+        # Returns a complete command and the remaining buffer, or None.
+        if not buf.startswith('*'):
+            return None, buf
+        end = buf.find('\r\n')
+        if end < 0:
+            return None, buf
+        count, pos, args = int(buf[1:end]), end + 2, []
+        for i in range(count):
+            end = buf.find('\r\n', pos)
+            if end < 0:
+                return None, buf
+            size = int(buf[pos+1:end])
+            if len(buf) < end + 2 + size + 2:
+                return None, buf
+            args.append(buf[end+2:end+2+size])
+            pos = end + 2 + size + 2
+        return args, buf[pos:]
+
+    def _encode(self, reply):
+        if isinstance(reply, Exception):
+            return '-ERR {0}\r\n'.format(reply)
+        if isinstance(reply, Status):
+            return '+{0}\r\n'.format(reply)
+        if isinstance(reply, (int, long)):
+            return ':{0}\r\n'.format(reply)
+        if reply is None:
+            return '$-1\r\n'
+        if isinstance(reply, list):
+            return '*{0}\r\n{1}'.format(len(reply), ''.join(
+                self._encode(item) for item in reply))
+        return '${0}\r\n{1}\r\n'.format(len(reply), reply)
+
+    def _execute(self, args):
+        name = args[0].upper()
+        if name == 'PING':
+            return Status('PONG')
+        elif name in ('SET', 'SETEX'):
+            self.data[args[1]] = args[-1]
+            return Status('OK')
+        elif name == 'GET':
+            return self.data.get(args[1])
+        elif name == 'DEL':
+            return sum(1 for key in args[1:]
+                       if self.data.pop(key, None) is not None)
+        elif name == 'EXPIRE':
+            return int(args[1] in self.data)
+        elif name in ('INCR', 'INCRBY'):
+            value = int(self.data.get(args[1], 0))
+            value += int(args[2]) if len(args) > 2 else 1
+            self.data[args[1]] = str(value)
+            return value
+        return ValueError('unknown command ' + name)
+
+    def _handle(self, conn):
+        buf, transaction = '', None
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                break
+            buf += data
+            replies = []
+            while True:
+                args, buf = self._parse(buf)
+                if args is None:
+                    break
+                name = args[0].upper()
+                if name == 'MULTI':
+                    transaction = []
+                    replies.append(Status('OK'))
+                elif name == 'EXEC':
+                    replies.append([self._execute(queued)
+                                    for queued in transaction])
+                    transaction = None
+                elif transaction is not None:
+                    transaction.append(args)
+                    replies.append(Status('QUEUED'))
+                else:
+                    replies.append(self._execute(args))
+            if not replies:
+                continue
+            delay = self.latency + random.uniform(-self.jitter, self.jitter)
+            eventlet.sleep(max(delay, 0))
+            if random.random() < self.failure_rate:
+                break
+            conn.sendall(''.join(self._encode(reply) for reply in replies))
+        conn.close()
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(int(len(values) * pct / 100.0), len(values) - 1)]
+
+
+class QuietLog(object):
+
+    def _ignore(self, *args, **kwargs):
+        pass
+
+    debug = info = warn = warning = error = exception = _ignore
+
+
+def run_scenario(args, mode, wait_for_remote, pool_size, remotes):
+    local = StandInRedis()
+    remote = [StandInRedis(args.remote_latency, args.jitter,
+                           args.failure_rate) for i in range(remotes)]
+    rmw = RedisMultiWrite(StrictRedis(port=local.port),
+                          [StrictRedis(port=server.port,
+                                       socket_timeout=args.socket_timeout)
+                           for server in remote],
+                          pool_size=pool_size, log=QuietLog(),
+                          wait_for_remote=wait_for_remote)
+    pipeline = [('set', ('key{0}'.format(i), 'value'))
+                for i in range(args.pipeline_size)]
+    latencies = []
+
+    def call(i):
+        start = time.time()
+        try:
+            if mode == 'run_everywhere':
+                rmw.set_everywhere('key{0}'.format(i), 'value')
+            else:
+                rmw.pipeline_everywhere(pipeline)
+        finally:
+            latencies.append(time.time() - start)
+
+    callers = eventlet.GreenPool(args.concurrency)
+    start = time.time()
+    for i in range(args.calls):
+        callers.spawn_n(call, i)
+    callers.waitall()
+    elapsed = time.time() - start
+    rmw.backend.pool.waitall()
+    commands = args.calls * (args.pipeline_size if mode != 'run_everywhere'
+                             else 1)
+    return {'mode': mode,
+            'wait_for_remote': wait_for_remote,
+            'pool_size': pool_size,
+            'remotes': remotes,
+            'calls': args.calls,
+            'calls_per_sec': args.calls / elapsed,
+            'commands_per_sec': commands / elapsed,
+            'p50': percentile(latencies, 50),
+            'p99': percentile(latencies, 99)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--calls', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--pipeline-size', type=int, default=10)
+    parser.add_argument('--remote-latency', type=float, default=0.02)
+    parser.add_argument('--jitter', type=float, default=0.005)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--socket-timeout', type=float, default=1.0)
+    parser.add_argument('--pool-sizes', type=int, nargs='+',
+                        default=[10, 100])
+    parser.add_argument('--remotes', type=int, nargs='+', default=[1, 3])
+    parser.add_argument('--output', type=argparse.FileType('w'),
+                        default=sys.stdout)
+    args = parser.parse_args()
+
+    monkey_patch()
+
+    scenarios = itertools.product(['run_everywhere', 'pipeline_everywhere'],
+                                  [False, True], args.pool_sizes,
+                                  args.remotes)
+    for scenario in scenarios:
+        result = run_scenario(args, *scenario)
+        args.output.write(json.dumps(result, sort_keys=True) + '\n')
+        args.output.flush()
+
+
+if __name__ == '__main__':
+    main()
+
+
+# vim:et:fdm=marker:sts=4:sw=4:ts=4
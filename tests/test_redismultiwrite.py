@@ -1,8 +1,16 @@
 
+import time
+import shutil
+import hashlib
+import tempfile
+
 import redis
 import redismultiwrite as redismw
 import unittest
+import eventlet
 import eventlet.debug
+import eventlet.event
+import eventlet.semaphore
 
 eventlet.debug.hub_exceptions(False)
 
@@ -14,7 +22,9 @@ class StrictRedisMock(object):
     def __init__(self, id, broken=False):
         self.id = id
         self.broken = broken
+        self.attempts = 0
         self.callstack = []
+        self.scripts = set()
         self.connection_pool = self.ConnectionPoolMock(id)
 
     def get(self, key):
@@ -29,10 +39,18 @@ class StrictRedisMock(object):
         self.callstack.append('delete')
         return key == 'good'
 
-    def set(self, key, value):
+    def set(self, key, value, ex=None, px=None, nx=False, xx=False):
+        self.attempts += 1
         if self.broken:
             raise redis.ConnectionError()
         self.callstack.append('set')
+        self.expiry = ex
+        return True
+
+    def mset(self, mapping):
+        if self.broken:
+            raise redis.ConnectionError()
+        self.callstack.append('mset')
         return True
 
     def setex(self, key, seconds, value):
@@ -41,21 +59,195 @@ class StrictRedisMock(object):
         self.callstack.append('setex')
         return True
 
+    def incrby(self, key, amount=1):
+        if self.broken:
+            raise redis.ConnectionError()
+        self.callstack.append('incrby')
+        return amount
+
+    incr = incrby
+
     def expire(self, key, seconds):
         if self.broken:
             raise redis.RedisError()
         self.callstack.append('expire')
         return key == 'good'
 
+    def ping(self):
+        if self.broken:
+            raise redis.ConnectionError()
+        return True
+
+    def script_load(self, script):
+        if self.broken:
+            raise redis.ConnectionError()
+        self.callstack.append('script_load')
+        sha = hashlib.sha1(script).hexdigest()
+        self.scripts.add(sha)
+        return sha
+
+    def evalsha(self, sha, numkeys, *args):
+        if self.broken:
+            raise redis.ConnectionError()
+        if sha not in self.scripts:
+            raise redis.exceptions.NoScriptError()
+        self.callstack.append('evalsha')
+        return 1
+
     def pipeline(self):
         if self.broken:
             raise redis.ConnectionError()
         self.callstack.append('pipeline')
         return self
 
-    def execute(self):
+    def execute(self, raise_on_error=True):
+        commands = self.callstack[::-1].index('pipeline')
         self.callstack.append('execute')
-        return 
+        return [True] * commands
+
+
+class SlowStrictRedisMock(StrictRedisMock):
+    def __init__(self, id):
+        super(SlowStrictRedisMock, self).__init__(id)
+        self.gate = eventlet.event.Event()
+
+    def set(self, key, value):
+        self.gate.wait()
+        return super(SlowStrictRedisMock, self).set(key, value)
+
+
+class ConcurrentStrictRedisMock(StrictRedisMock):
+    def __init__(self, id):
+        super(ConcurrentStrictRedisMock, self).__init__(id)
+        self.active = self.most_active = 0
+        self.values = []
+
+    def set(self, key, value):
+        self.active += 1
+        self.most_active = max(self.most_active, self.active)
+        eventlet.sleep(0.01 * (value % 2))
+        self.values.append(value)
+        self.active -= 1
+        return True
+
+    def pipeline(self):
+        return self
+
+    def execute(self, raise_on_error=True):
+        return [True]
+
+
+class PackedConnectionMock(redis.Connection):
+    sent = []
+
+    def send_packed_command(self, command):
+        self.sent.append(command)
+
+    def read_response(self):
+        return 'OK'
+
+
+class PingConnectionMock(redis.Connection):
+    pings = []
+
+    def send_command(self, *args):
+        if self.host == 'broken':
+            raise redis.ConnectionError()
+        self.pings.append(self.host)
+
+    def read_response(self):
+        return 'PONG'
+
+
+def ping_redis(host):
+    pool = redis.ConnectionPool(connection_class=PingConnectionMock,
+                                host=host)
+    return redis.StrictRedis(connection_pool=pool)
+
+
+class KeyspaceRedisMock(object):
+    def __init__(self, data):
+        self.data = dict(data)
+
+    def scan(self, cursor, count=None):
+        keys = sorted(self.data)
+        cursor = int(cursor)
+        return cursor + count if cursor + count < len(keys) else 0, \
+            keys[cursor:cursor+count]
+
+    def eval(self, script, numkeys, *args):
+        keys, per_key = args[:numkeys], args[-1] == 'keys'
+        digests = [hashlib.sha1(key+'\0'+self.data[key]+'\0-1').hexdigest()
+                   if key in self.data else '' for key in keys]
+        return digests if per_key else hashlib.sha1(''.join(digests)).hexdigest()
+
+    def dump(self, key):
+        return self.data.get(key)
+
+    def pttl(self, key):
+        return -1 if key in self.data else -2
+
+    def delete(self, *keys):
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    def set(self, key, value):
+        self.data[key] = value
+        return True
+
+    def mset(self, mapping):
+        self.data.update(mapping)
+        return True
+
+    def msetnx(self, mapping):
+        if any(key in self.data for key in mapping):
+            return False
+        self.data.update(mapping)
+        return True
+
+    def restore(self, key, ttl, value):
+        self.data[key] = value
+        return True
+
+    def pipeline(self):
+        return KeyspacePipelineMock(self)
+
+
+class KeyspacePipelineMock(object):
+    def __init__(self, conn):
+        self.conn = conn
+        self.queued = []
+
+    def __getattr__(self, name):
+        method = getattr(self.conn, name)
+        return lambda *args: self.queued.append((method, args))
+
+    def execute(self, raise_on_error=True):
+        results = []
+        for method, args in self.queued:
+            try:
+                results.append(method(*args))
+            except redis.RedisError, e:
+                if raise_on_error:
+                    raise
+                results.append(e)
+        return results
+
+
+class ScriptRedisMock(KeyspaceRedisMock):
+    def __init__(self, data):
+        super(ScriptRedisMock, self).__init__(data)
+        self.scripts = set()
+
+    def script_load(self, script):
+        sha = hashlib.sha1(script).hexdigest()
+        self.scripts.add(sha)
+        return sha
+
+    def evalsha(self, sha, numkeys, *args):
+        if sha not in self.scripts:
+            raise redis.exceptions.NoScriptError()
+        self.data[args[0]] = self.data.get(args[0], 0) + 1
+        return 1
 
 
 class RedisMultiWriteTest(unittest.TestCase):
@@ -101,6 +293,16 @@ class RedisMultiWriteTest(unittest.TestCase):
             broken.delete_everywhere('good')
         self.assertEquals('broken', cm.exception.host)
 
+    def test_broken_address(self):
+        local = StrictRedisMock('broken', True)
+        local.connection_pool.connection_kwargs['port'] = 6380
+        broken = redismw.RedisMultiWrite(local)
+        with self.assertRaises(redismw.TooManyRetries) as cm:
+            broken.delete_everywhere('good')
+        self.assertEquals('broken', cm.exception.host)
+        self.assertEquals('broken:6380', cm.exception.address)
+        self.assertTrue('broken:6380' in broken.stats())
+
     def test_run_everywhere_get(self):
         ret = self.redismw.run_everywhere('get', ('good', ))
         self.assertEquals('value', ret)
@@ -159,4 +361,749 @@ class RedisMultiWriteTest(unittest.TestCase):
         self.assertEquals(expected, self.remote[1].callstack)
         self.assertEquals([], self.remote[2].callstack)
 
+    def test_batch_everywhere(self):
+        batched = redismw.RedisMultiWrite(self.local, self.remote,
+                                          wait_for_remote=True, batch_size=10)
+        calls = [eventlet.spawn(batched.set_everywhere, 'good', 'value'),
+                 eventlet.spawn(batched.delete_everywhere, 'good')]
+        self.assertEquals([True, True], [call.wait() for call in calls])
+        self.assertEquals(['set', 'delete'], self.local.callstack)
+        expected = ['pipeline', 'set', 'delete', 'execute']
+        self.assertEquals(expected, self.remote[0].callstack)
+        self.assertEquals(expected, self.remote[1].callstack)
+        self.assertEquals([], self.remote[2].callstack)
+
+    def test_batch_size(self):
+        batched = redismw.RedisMultiWrite(self.local, self.remote[:1],
+                                          wait_for_remote=True, batch_size=2)
+        calls = [eventlet.spawn(batched.set_everywhere, 'good', 'value')
+                 for i in range(3)]
+        [call.wait() for call in calls]
+        expected = ['pipeline', 'set', 'set', 'execute', 'set']
+        self.assertEquals(expected, self.remote[0].callstack)
+
+    def test_queue_overflow_drop(self):
+        slow = SlowStrictRedisMock('slow')
+        queued = redismw.RedisMultiWrite(self.local, [slow], queue_size=1,
+                                         overflow='drop')
+        for i in range(3):
+            queued.set_everywhere('good', 'value')
+        self.assertEquals({'slow:6379': 1}, queued.queue_depth())
+        slow.gate.send()
+        eventlet.sleep(0.01)
+        self.assertEquals({'slow:6379': 0}, queued.queue_depth())
+        self.assertEquals(['set', 'set'], slow.callstack)
+
+    def test_queue_overflow_spill(self):
+        slow = SlowStrictRedisMock('slow')
+        queued = redismw.RedisMultiWrite(self.local, [slow], queue_size=1,
+                                         overflow='spill')
+        for i in range(3):
+            queued.set_everywhere('good', 'value')
+        self.assertEquals({'slow:6379': 2}, queued.queue_depth())
+        slow.gate.send()
+        eventlet.sleep(0.01)
+        self.assertEquals({'slow:6379': 0}, queued.queue_depth())
+        self.assertEquals(['set', 'set', 'set'], slow.callstack)
+
+    def test_close_queue(self):
+        slow = SlowStrictRedisMock('slow')
+        queued = redismw.RedisMultiWrite(self.local, [slow], queue_size=1,
+                                         overflow='spill', queue_workers=2)
+        for i in range(3):
+            queued.set_everywhere('good', 'value')
+        workers = queued.queues[id(slow)].workers
+        eventlet.spawn(queued.close)
+        slow.gate.send()
+        eventlet.sleep(0.01)
+        self.assertEquals(['set', 'set', 'set'], slow.callstack)
+        self.assertTrue(all(worker.dead for worker in workers))
+
+    def test_queue_overflow_block(self):
+        slow = SlowStrictRedisMock('slow')
+        queued = redismw.RedisMultiWrite(self.local, [slow], queue_size=1)
+        for i in range(2):
+            queued.set_everywhere('good', 'value')
+        blocked = eventlet.spawn(queued.set_everywhere, 'good', 'value')
+        eventlet.sleep(0.01)
+        self.assertFalse(blocked.dead)
+        slow.gate.send()
+        self.assertTrue(blocked.wait())
+        self.assertEquals(['set', 'set', 'set'], self.local.callstack)
+
+    def test_journal_replay(self):
+        journal_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, journal_dir)
+        broken = StrictRedisMock('broken', True)
+        journaled = redismw.RedisMultiWrite(self.local, [broken],
+                                            wait_for_remote=True,
+                                            journal_dir=journal_dir,
+                                            journal_interval=0.01)
+        journaled.set_everywhere('good', 'value')
+        journaled.delete_everywhere('good')
+        self.assertEquals([], broken.callstack)
+        broken.broken = False
+        eventlet.sleep(0.05)
+        self.assertEquals(['pipeline', 'set', 'delete', 'execute'],
+                          broken.callstack)
+        journaled.expire_everywhere('good', 10)
+        self.assertEquals('expire', broken.callstack[-1])
+
+    def test_journal_replay_rate_limited(self):
+        journal_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, journal_dir)
+        broken = StrictRedisMock('broken', True)
+        journaled = redismw.RedisMultiWrite(self.local, [broken],
+                                            journal_dir=journal_dir,
+                                            journal_interval=0.01,
+                                            batch_size=10,
+                                            rate_limits={'broken:6379': {
+                                                'ops': 20}})
+        for i in range(40):
+            journaled.set_everywhere('good', 'value')
+        broken.broken = False
+        eventlet.sleep(0.1)
+        self.assertTrue(0 < broken.callstack.count('set') < 40)
+
+    def test_journal_torn_tail(self):
+        journal_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, journal_dir)
+        broken = StrictRedisMock('broken', True)
+        journaled = redismw.RedisMultiWrite(self.local, [broken],
+                                            wait_for_remote=True,
+                                            journal_dir=journal_dir,
+                                            journal_interval=0.01)
+        journaled.set_everywhere('good', 'value')
+        with open(journal_dir + '/broken-6379.journal', 'ab') as journal:
+            journal.write('\x00\x00\x10\x00partial')
+        broken.broken = False
+        restarted = redismw.RedisMultiWrite(self.local, [broken],
+                                            wait_for_remote=True,
+                                            journal_dir=journal_dir,
+                                            journal_interval=0.01)
+        eventlet.sleep(0.05)
+        self.assertEquals(['pipeline', 'set', 'execute'], broken.callstack)
+        restarted.delete_everywhere('good')
+        self.assertEquals('delete', broken.callstack[-1])
+
+    def test_journal_shared(self):
+        journal_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, journal_dir)
+        path = journal_dir + '/shared.journal'
+        first = redismw._Journal(path, eventlet.semaphore.Semaphore())
+        second = redismw._Journal(path, eventlet.semaphore.Semaphore())
+        first.compact_size = 1
+        first.append([('set', ('good', 'value'))])
+        second.append([('delete', ('good', ))])
+        self.assertEquals(2, len(first))
+        self.assertTrue(first.claim())
+        self.assertFalse(second.claim())
+        commands, entries, pos, skipped = first.read(1)
+        self.assertEquals([('set', ('good', 'value'))], commands)
+        first.ack(entries, pos)
+        second.append([('set', ('good', 'value'))])
+        commands, entries, pos, skipped = first.read(10)
+        self.assertEquals([('delete', ('good', )),
+                           ('set', ('good', 'value'))], commands)
+        first.ack(entries, pos)
+        self.assertEquals(0, len(second))
+        self.assertTrue(first.stop_replay())
+        self.assertTrue(second.claim())
+
+    def test_min_remote_acks(self):
+        slow = SlowStrictRedisMock('slow')
+        quorum = redismw.RedisMultiWrite(self.local, [slow, self.remote[0]],
+                                         min_remote_acks=1)
+        self.assertTrue(quorum.set_everywhere('good', 'value'))
+        self.assertEquals(['set'], self.remote[0].callstack)
+        self.assertEquals([], slow.callstack)
+        slow.gate.send()
+
+    def test_min_remote_acks_not_reached(self):
+        with self.assertRaises(redismw.QuorumNotReached) as cm:
+            self.redismw.set_everywhere('good', 'value', min_remote_acks=3)
+        self.assertEquals(2, cm.exception.acks)
+        self.assertTrue(cm.exception.result)
+
+    def test_circuit_breaker(self):
+        broken = self.remote[2]
+        breaker = redismw.RedisMultiWrite(self.local, [broken],
+                                          wait_for_remote=True,
+                                          breaker_threshold=1,
+                                          breaker_timeout=0.01)
+        breaker.set_everywhere('good', 'value')
+        self.assertEquals(3, broken.attempts)
+        breaker.set_everywhere('good', 'value')
+        self.assertEquals(3, broken.attempts)
+        broken.broken = False
+        eventlet.sleep(0.02)
+        breaker.set_everywhere('good', 'value')
+        self.assertEquals(['set'], broken.callstack)
+
+    def test_retry_backoff(self):
+        backoff = redismw.RedisMultiWrite(StrictRedisMock('broken', True),
+                                          retry_backoff=0.001)
+        with self.assertRaises(redismw.TooManyRetries):
+            backoff.set_everywhere('good', 'value')
+
+    def test_threads_backend(self):
+        threaded = redismw.RedisMultiWrite(self.local, self.remote,
+                                           wait_for_remote=True,
+                                           backend='threads')
+        self.assertTrue(threaded.delete_everywhere('good'))
+        self.assertEquals(['delete'], self.local.callstack)
+        self.assertEquals(['delete'], self.remote[0].callstack)
+        self.assertEquals(['delete'], self.remote[1].callstack)
+        self.assertEquals([], self.remote[2].callstack)
+
+    def test_threads_backend_batch(self):
+        threaded = redismw.RedisMultiWrite(self.local, self.remote[:1],
+                                           wait_for_remote=True,
+                                           batch_size=10, backend='threads')
+        self.assertTrue(threaded.delete_everywhere('good'))
+        self.assertEquals(['delete'], self.remote[0].callstack)
+
+    def test_inline_backend(self):
+        inline = redismw.RedisMultiWrite(self.local, self.remote,
+                                         backend='inline')
+        self.assertTrue(inline.delete_everywhere('good'))
+        self.assertEquals(['delete'], self.remote[0].callstack)
+        self.assertEquals(['delete'], self.remote[1].callstack)
+        with self.assertRaises(ValueError):
+            redismw.RedisMultiWrite(self.local, self.remote, batch_size=10,
+                                    backend='inline')
+
+    def test_stats(self):
+        metrics = []
+        hooked = redismw.RedisMultiWrite(self.local, self.remote,
+                                         wait_for_remote=True,
+                                         stats_hooks=[lambda *args:
+                                                      metrics.append(args)])
+        hooked.delete_everywhere('good')
+        hooked.expire_everywhere('good', 10)
+        stats = hooked.stats()
+        self.assertEquals(2, stats['local:6379']['sent'])
+        self.assertEquals(2, stats['local:6379']['successes'])
+        self.assertEquals(0, stats['local:6379']['errors'])
+        self.assertEquals(1, sum(count for bound, count
+                                 in stats['local:6379']['latency']['delete']))
+        self.assertEquals(4, stats['remote3:6379']['sent'])
+        self.assertEquals(2, stats['remote3:6379']['retries'])
+        self.assertEquals(1, stats['remote3:6379']['too_many_retries'])
+        self.assertEquals(1, stats['remote3:6379']['errors'])
+        self.assertTrue(('remote1:6379', 'delete', 'successes', 1) in metrics)
+        failing = redismw.RedisMultiWrite(self.local, self.remote,
+                                          wait_for_remote=True,
+                                          stats_hooks=[lambda *args: 1 / 0])
+        self.assertTrue(failing.delete_everywhere('good'))
+        self.assertEquals(1, failing.stats()['remote1:6379']['successes'])
+
+    def test_encode_once(self):
+        PackedConnectionMock.sent = []
+        conns = [redis.StrictRedis(connection_pool=redis.ConnectionPool(
+                     connection_class=PackedConnectionMock))
+                 for i in range(3)]
+        packed = redismw.RedisMultiWrite(conns[0], conns[1:],
+                                         wait_for_remote=True,
+                                         encode_once=True)
+        self.assertTrue(packed.set_everywhere('good', 'x' * 10000))
+        sent = PackedConnectionMock.sent
+        self.assertEquals(3, len(sent))
+        self.assertTrue(sent[0] is sent[1] is sent[2])
+        self.assertEquals('x' * 10000, sent[0][1])
+
+    def test_encode_once_sharded(self):
+        class DeleteConnectionMock(PackedConnectionMock):
+            def read_response(self):
+                return 2
+        local = redis.StrictRedis(connection_pool=redis.ConnectionPool(
+            connection_class=DeleteConnectionMock))
+        shards = [StrictRedisMock('shard0'), StrictRedisMock('shard1')]
+        sharded = redismw.ShardedRedis(shards)
+        keys = ['key%d' % i for i in range(100)]
+        first = [key for key in keys if sharded.index(key) == 0][0]
+        second = [key for key in keys if sharded.index(key) == 1][0]
+        packed = redismw.RedisMultiWrite(local, [sharded],
+                                         wait_for_remote=True,
+                                         encode_once=True)
+        self.assertEquals(2, packed.delete_everywhere(first, second))
+        self.assertEquals(['delete'], shards[0].callstack)
+        self.assertEquals(['delete'], shards[1].callstack)
+
+    def test_encode_once_fallback(self):
+        packed = redismw.RedisMultiWrite(self.local, self.remote,
+                                         encode_once=True)
+        self.assertTrue(packed.delete_everywhere('good'))
+        self.assertEquals(['delete'], self.remote[0].callstack)
+
+    def test_coalesce(self):
+        coalesced = redismw.RedisMultiWrite(self.local, self.remote[:1],
+                                            batch_size=10, batch_window=0.05,
+                                            coalesce=True)
+        coalesced.set_everywhere('good', 'value')
+        coalesced.incr_everywhere('counter')
+        coalesced.set_everywhere('good', 'value')
+        coalesced.incrby_everywhere('counter', 5)
+        eventlet.sleep(0.1)
+        self.assertEquals(['pipeline', 'set', 'incrby', 'execute'],
+                          self.remote[0].callstack)
+
+    def test_auto_replicate(self):
+        auto = redismw.RedisMultiWrite(self.local, self.remote,
+                                       auto_replicate=True)
+        self.assertTrue(auto.delete('good'))
+        self.assertEquals('value', auto.get('good'))
+        self.assertEquals(['delete', 'get'], self.local.callstack)
+        self.assertEquals(['delete'], self.remote[0].callstack)
+        self.assertEquals(['delete'], self.remote[1].callstack)
+        self.assertTrue(auto.set('good', 'value', ex=10, timeout=1))
+        eventlet.sleep(0.01)
+        self.assertEquals(10, self.local.expiry)
+        self.assertEquals(10, self.remote[0].expiry)
+        self.assertEquals(('key', 'value', None, None, True),
+                          redismw._positional('set', ('key', 'value'),
+                                              {'nx': True}))
+        self.assertEquals(('key', 2), redismw._positional(
+            'incrby', ('key', ), {'amount': 2}))
+        self.assertEquals(({'a': 1, 'b': 2}, ), redismw._positional(
+            'mset', ({'a': 1}, ), {'b': 2}))
+        self.assertEquals(('key', 1, 'a', 2, 'b'), redismw._positional(
+            'zadd', ('key', 1, 'a'), {'b': 2}))
+        with self.assertRaises(TypeError):
+            auto.set('good', 'value', expiry=10)
+        self.assertTrue('pfadd' in redismw.WRITE_COMMANDS)
+        self.assertFalse('spop' in redismw.WRITE_COMMANDS)
+
+    def test_dispatch_cached(self):
+        method = self.redismw.delete_everywhere
+        self.assertTrue(method is self.redismw.delete_everywhere)
+        self.assertTrue(self.redismw.get is self.redismw.get)
+
+    def test_stream_order(self):
+        remote = ConcurrentStrictRedisMock('remote1')
+        streamed = redismw.RedisMultiWrite(self.local, [remote])
+        streamed.stream_everywhere((('set', ('key', i)) for i in range(4)),
+                                   chunk_size=1)
+        self.assertEquals([0, 1, 2, 3], remote.values)
+        self.assertEquals(1, remote.most_active)
+        streamed.stream_everywhere((('set', ('key%d' % i, i))
+                                    for i in range(4)), chunk_size=1)
+        self.assertEquals(2, remote.most_active)
+
+    def test_stream_everywhere(self):
+        commands = (('set', ('good', 'value')) for i in range(5))
+        self.assertEquals(5, self.redismw.stream_everywhere(commands,
+                                                            chunk_size=2))
+        expected = ['pipeline', 'set', 'set', 'execute'] * 2 + \
+                   ['pipeline', 'set', 'execute']
+        self.assertEquals(expected, self.local.callstack)
+        self.assertEquals(expected, self.remote[0].callstack)
+        self.assertEquals([], self.remote[2].callstack)
+
+    def test_stream_everywhere_results(self):
+        commands = [('set', ('good', 'value')), ('delete', ('good', ))]
+        results = self.redismw.stream_everywhere(commands, chunk_size=1,
+                                                 results=True)
+        self.assertEquals([], self.local.callstack)
+        self.assertEquals([True, True], list(results))
+
+    def test_adaptive_batching(self):
+        adaptive = redismw.RedisMultiWrite(self.local, batch_size=2,
+                                           adaptive_batching=True)
+        commands = [('set', ('good', 'value'))] * 100
+        self.assertEquals(100, adaptive.stream_everywhere(commands))
+        window = adaptive.stats()['local:6379']['window']
+        self.assertTrue(window['size'] > 2)
+        self.assertTrue(window['depth'] >= 1)
+
+    def test_adaptive_batching_sharded(self):
+        shards = [StrictRedisMock('shard%d' % i) for i in range(2)]
+        sharded = redismw.ShardedRedis(shards, name='dc2')
+        adaptive = redismw.RedisMultiWrite(self.local, [sharded],
+                                           wait_for_remote=True, batch_size=2,
+                                           adaptive_batching=True)
+        commands = [('set', ('key%d' % i, 'value')) for i in range(100)]
+        self.assertEquals(100, adaptive.stream_everywhere(commands))
+        window = adaptive.stats()['dc2']['window']
+        self.assertTrue(window['size'] > 2)
+
+    def test_timeout_remote(self):
+        slow = SlowStrictRedisMock('slow')
+        waiting = redismw.RedisMultiWrite(self.local, [slow],
+                                          wait_for_remote=True)
+        with self.assertRaises(redismw.DeadlineExceeded) as cm:
+            waiting.set_everywhere('good', 'value', timeout=0.01)
+        self.assertTrue(cm.exception.result)
+        slow.gate.send()
+
+    def test_timeout_local(self):
+        slow = SlowStrictRedisMock('slow')
+        waiting = redismw.RedisMultiWrite(slow, self.remote)
+        with self.assertRaises(redismw.DeadlineExceeded):
+            waiting.pipeline_everywhere([('set', ('good', 'value'))],
+                                        timeout=0.01)
+        slow.gate.send()
+
+    def test_keyspace_sync(self):
+        data = dict(('key%d' % i, 'value%d' % i) for i in range(500))
+        local = KeyspaceRedisMock(data)
+        remote = KeyspaceRedisMock(data)
+        remote.data['key7'] = 'stale'
+        remote.data['extra'] = 'value'
+        del remote.data['key300']
+        rmw = redismw.RedisMultiWrite(local, [remote])
+        sync = redismw.KeyspaceSync(rmw, fanout=4, leaf_size=50)
+        stats = sync.sync()
+        self.assertEquals(data, remote.data)
+        self.assertEquals(2, stats[0]['restored'])
+        self.assertEquals(1, stats[0]['deleted'])
+        self.assertTrue(stats[0]['differing'] < stats[0]['ranges'])
+        self.assertEquals([{'ranges': 1, 'differing': 0, 'restored': 0,
+                            'deleted': 0}], sync.sync())
+
+    def test_keyspace_sync_sharded(self):
+        data = dict(('key%d' % i, 'value%d' % i) for i in range(300))
+        shards = [KeyspaceRedisMock({}), KeyspaceRedisMock({})]
+        sharded = redismw.ShardedRedis(shards)
+        for key in data:
+            if key != 'key7':
+                shards[sharded.index(key)].data[key] = data[key]
+        shards[0].data['extra'] = 'value'
+        rmw = redismw.RedisMultiWrite(KeyspaceRedisMock(data), [sharded])
+        stats = redismw.KeyspaceSync(rmw, fanout=4, leaf_size=50).sync()
+        self.assertEquals(1, stats[0]['restored'])
+        self.assertEquals(1, stats[0]['deleted'])
+        for index, shard in enumerate(shards):
+            self.assertEquals(dict((key, value) for key, value in data.items()
+                                   if sharded.index(key) == index),
+                              shard.data)
+        self.assertEquals(0, redismw.KeyspaceSync(rmw).sync()[0]['differing'])
+
+    def test_keyspace_sync_key_filters(self):
+        local = KeyspaceRedisMock({'eu:1': 'value', 'us:1': 'value'})
+        remote = KeyspaceRedisMock({'us:2': 'value'})
+        rmw = redismw.RedisMultiWrite(local, [remote],
+                                      key_filters={'[Unknown]': ['eu:']})
+        stats = redismw.KeyspaceSync(rmw).sync()
+        self.assertEquals(1, stats[0]['restored'])
+        self.assertEquals(0, stats[0]['deleted'])
+        self.assertEquals({'eu:1': 'value', 'us:2': 'value'}, remote.data)
+
+    def test_keyspace_sync_dry_run(self):
+        local = KeyspaceRedisMock({'key': 'value'})
+        remote = KeyspaceRedisMock({})
+        rmw = redismw.RedisMultiWrite(local, [remote])
+        stats = redismw.KeyspaceSync(rmw, dry_run=True).sync()
+        self.assertEquals(1, stats[0]['restored'])
+        self.assertEquals({}, remote.data)
+        with self.assertRaises(ValueError):
+            redismw.KeyspaceSync(rmw, fanout=1)
+
+    def test_warmup(self):
+        del PingConnectionMock.pings[:]
+        warm = redismw.RedisMultiWrite(ping_redis('local'),
+                                       [ping_redis('remote1'),
+                                        ping_redis('broken')],
+                                       warmup=True, warmup_connections=3)
+        self.assertEquals(['local'] * 3 + ['remote1'] * 3,
+                          sorted(PingConnectionMock.pings))
+        self.assertEquals(['broken:6379'], warm.unreachable)
+        pool = warm.local.connection_pool
+        self.assertEquals(3, len(pool._available_connections))
+
+    def test_keepalive(self):
+        del PingConnectionMock.pings[:]
+        kept = redismw.RedisMultiWrite(ping_redis('local'),
+                                       [ping_redis('remote1')],
+                                       keepalive_interval=0.01)
+        eventlet.sleep(0.05)
+        self.assertTrue(PingConnectionMock.pings.count('remote1') >= 2)
+        kept.close()
+        eventlet.sleep(0.02)
+        pings = len(PingConnectionMock.pings)
+        eventlet.sleep(0.05)
+        self.assertEquals(pings, len(PingConnectionMock.pings))
+
+    def test_register_script(self):
+        sha = self.redismw.register_script('return 1')
+        self.assertEquals(1, self.redismw.evalsha_everywhere(sha, 0))
+        self.redismw.evalsha_everywhere(sha, 0)
+        self.assertEquals(['script_load', 'evalsha', 'evalsha'],
+                          self.local.callstack)
+        self.assertEquals(['script_load', 'evalsha', 'evalsha'],
+                          self.remote[0].callstack)
+
+    def test_script_reloaded(self):
+        sha = self.redismw.register_script('return 1')
+        self.remote[0].scripts.clear()
+        self.redismw.evalsha_everywhere(sha, 0)
+        self.assertEquals(['script_load', 'script_load', 'evalsha'],
+                          self.remote[0].callstack)
+        self.assertEquals(0, self.redismw.stats()['remote1:6379']['retries'])
+
+    def test_script_reloaded_in_pipeline(self):
+        remote = ScriptRedisMock({})
+        scripted = redismw.RedisMultiWrite(ScriptRedisMock({}), [remote],
+                                           wait_for_remote=True)
+        sha = scripted.register_script('return 1')
+        remote.scripts.clear()
+        scripted.pipeline_everywhere([('evalsha', (sha, 1, 'a')),
+                                      ('set', ('b', 1)),
+                                      ('evalsha', (sha, 1, 'a'))])
+        self.assertEquals({'a': 2, 'b': 1}, remote.data)
+        self.assertEquals(0, scripted.stats()['[Unknown]']['retries'])
+
+    def test_lanes(self):
+        slow = SlowStrictRedisMock('slow')
+        lanes = redismw.RedisMultiWrite(self.local, [slow],
+                                        lanes={'interactive': None, 'bulk': 1})
+        lanes.set_everywhere('good', 'value', lane='bulk')
+        eventlet.sleep(0)
+        self.assertTrue(lanes.delete_everywhere('good', lane='interactive',
+                                                min_remote_acks=1,
+                                                timeout=1.0))
+        self.assertEquals(0, lanes.lanes['bulk'].pool.free())
+        slow.gate.send()
+        with self.assertRaises(ValueError):
+            lanes.delete_everywhere('good', lane='unknown')
+
+    def test_lane_queues(self):
+        lanes = redismw.RedisMultiWrite(self.local, self.remote, queue_size=10,
+                                        lanes={'bulk': 10})
+        self.assertTrue(lanes.queues is not lanes.lane_queues['bulk'])
+        lanes.set_everywhere('good', 'value', lane='bulk', min_remote_acks=2)
+        self.assertEquals(['set'], self.remote[0].callstack)
+        self.assertEquals({'remote1:6379': 0, 'remote2:6379': 0,
+                           'remote3:6379': 0},
+                          lanes.queue_depth('bulk'))
+
+    def test_replication_token(self):
+        ret, token = self.redismw.set_everywhere('good', 'value', token=True)
+        self.assertTrue(ret)
+        self.assertTrue(self.redismw.wait_replicated(
+            token, ['remote1:6379', 'remote2:6379']))
+        self.assertEquals(['set'], self.remote[1].callstack)
+        self.assertFalse(self.redismw.wait_replicated(token))
+        with self.assertRaises(ValueError):
+            self.redismw.wait_replicated(token, ['unknown'])
+
+    def test_replication_token_ports(self):
+        slow = SlowStrictRedisMock('remote1')
+        slow.connection_pool.connection_kwargs['port'] = 6380
+        tokens = redismw.RedisMultiWrite(self.local, [self.remote[0], slow])
+        ret, token = tokens.set_everywhere('good', 'value', token=True)
+        with self.assertRaises(redismw.DeadlineExceeded):
+            tokens.wait_replicated(token, timeout=0.01)
+        self.assertTrue(tokens.wait_replicated(token, ['remote1:6379']))
+        self.assertEquals(['remote1:6379', 'remote1:6380'],
+                          sorted(tokens.lag()))
+        slow.gate.send()
+
+    def test_replication_token_timeout(self):
+        slow = SlowStrictRedisMock('slow')
+        tokens = redismw.RedisMultiWrite(self.local, [slow])
+        ret, token = tokens.pipeline_everywhere([('set', ('good', 'value'))],
+                                                token=True)
+        self.assertEquals([True], ret)
+        with self.assertRaises(redismw.DeadlineExceeded):
+            tokens.wait_replicated(token, timeout=0.01)
+        slow.gate.send()
+        self.assertTrue(tokens.wait_replicated(token, timeout=1.0))
+
+    def test_sharded_remote(self):
+        shards = [StrictRedisMock('shard%d' % i) for i in range(4)]
+        sharded = redismw.ShardedRedis(shards, name='dc2')
+        shardmw = redismw.RedisMultiWrite(self.local, [sharded],
+                                          min_remote_acks=1)
+        commands = [('set', ('key%d' % i, 'value')) for i in range(100)]
+        self.assertEquals([True] * 100, shardmw.pipeline_everywhere(commands))
+        sets = [shard.callstack.count('set') for shard in shards]
+        self.assertEquals(100, sum(sets))
+        self.assertTrue(all(sets))
+        shardmw.delete_everywhere('key1')
+        self.assertEquals(['delete'],
+                          shards[sharded.index('key1')].callstack[-1:])
+        self.assertTrue('dc2' in shardmw.stats())
+
+    def test_sharded_retries_failed_shard_only(self):
+        shards = [StrictRedisMock('shard0'), StrictRedisMock('shard1', True)]
+        sharded = redismw.ShardedRedis(shards)
+        keys = ['key%d' % i for i in range(100)]
+        healthy = [key for key in keys if sharded.index(key) == 0][0]
+        broken = [key for key in keys if sharded.index(key) == 1][0]
+        shardmw = redismw.RedisMultiWrite(self.local, [sharded],
+                                          wait_for_remote=True)
+        shardmw.pipeline_everywhere([('incrby', (healthy, 1)),
+                                     ('incrby', (broken, 1))])
+        self.assertEquals(['pipeline', 'incrby', 'execute'],
+                          shards[0].callstack)
+
+    def test_sharded_multi_key(self):
+        shards = [KeyspaceRedisMock({}) for i in range(4)]
+        sharded = redismw.ShardedRedis(shards)
+        shardmw = redismw.RedisMultiWrite(KeyspaceRedisMock({}), [sharded],
+                                          wait_for_remote=True)
+        keys = list('abcdefg')
+        shardmw.pipeline_everywhere([('mset', (dict.fromkeys(keys, '1'), )),
+                                     ('set', ('h', '1'))])
+        for index, shard in enumerate(shards):
+            self.assertEquals(set(key for key in keys + ['h']
+                                  if sharded.index(key) == index),
+                              set(shard.data))
+        self.assertTrue(len(set(sharded.index(key) for key in keys)) > 1)
+        self.assertEquals([7, True], shardmw._sharded_pipe_exec(
+            sharded, [('delete', tuple(keys)), ('mset', ({'x': '1'}, ))]))
+        self.assertEquals(['x'], [key for shard in shards
+                                  for key in shard.data if key != 'h'])
+        tagged = dict.fromkeys(['{q}a', '{q}b'], '1')
+        self.assertTrue(sharded.msetnx(tagged))
+        self.assertEquals(tagged, dict(
+            (key, value) for key, value
+            in shards[sharded.index('q')].data.items() if key in tagged))
+        spread = dict((key, '1') for key in keys)
+        with self.assertRaises(ValueError):
+            sharded.msetnx(spread)
+        self.assertEquals(7, sharded.mset(spread) and sharded.delete(*keys))
+
+    def test_shard_routing(self):
+        shards = [StrictRedisMock('shard%d' % i) for i in range(4)]
+        sharded = redismw.ShardedRedis(shards[:3])
+        grown = redismw.ShardedRedis(shards)
+        keys = ['key%d' % i for i in range(1000)]
+        moved = sum(1 for key in keys
+                    if sharded.index(key) != grown.index(key))
+        self.assertTrue(moved < 400)
+        self.assertEquals(sharded.index('{user1}.a'),
+                          sharded.index('{user1}.b'))
+        self.assertEquals(0x31c3, redismw._crc16('123456789'))
+        slots = redismw.ShardedRedis(shards, routing='slots')
+        self.assertEquals(0x31c3 * 4 // 16384, slots.index('123456789'))
+
+    def test_key_filters(self):
+        filtered = redismw.RedisMultiWrite(self.local, self.remote,
+                                           wait_for_remote=True,
+                                           key_filters={
+                                               'remote1:6379': 'tenant1:*',
+                                               'remote2:6379': ['tenant2:'],
+                                               'remote3:6379':
+                                                   lambda key: False})
+        filtered.pipeline_everywhere([('set', ('tenant1:a', 'value')),
+                                      ('set', ('tenant2:a', 'value')),
+                                      ('delete', ('tenant2:b', ))])
+        self.assertEquals(['set'], self.remote[0].callstack)
+        self.assertEquals(['pipeline', 'set', 'delete', 'execute'],
+                          self.remote[1].callstack)
+        self.assertEquals(0, self.remote[2].attempts)
+        self.assertEquals(3, filtered.set_everywhere('tenant1:a', 'value',
+                                                     token=True)[1].acks)
+        filtered.mset_everywhere({'tenant1:b': 'value'})
+        self.assertEquals('mset', self.remote[1].callstack[-1])
+        filtered.set_everywhere(1, 'value')
+        self.assertEquals(['set', 'set', 'mset'], self.remote[0].callstack)
+        with self.assertRaises(ValueError):
+            redismw.RedisMultiWrite(self.local, self.remote,
+                                    key_filters={'unknown': '*'})
+        broken = redismw.RedisMultiWrite(self.local, self.remote,
+                                         key_filters={'remote1:6379':
+                                                      lambda key: 1 / 0})
+        attempts = self.local.attempts
+        with self.assertRaises(ZeroDivisionError):
+            broken.set_everywhere('key', 'value')
+        self.assertEquals(attempts, self.local.attempts)
+
+    def test_ring_replication(self):
+        ring_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, ring_dir)
+        ring_path = ring_dir + '/ring'
+        writer = redismw.RedisMultiWrite(self.local, ring_path=ring_path,
+                                         ring_size=4096)
+        writer.set_everywhere('good', 'value')
+        writer.pipeline_everywhere([('delete', ('good', )),
+                                    ('set', ('good', 'value'))])
+        self.assertEquals(['set', 'pipeline', 'delete', 'set', 'execute'],
+                          self.local.callstack)
+        self.assertEquals([], self.remote[0].callstack)
+        replicator = redismw.RedisMultiWrite(None, self.remote,
+                                             ring_interval=0.01)
+        thread = eventlet.spawn(replicator.replicate_ring, ring_path)
+        eventlet.sleep(0.05)
+        thread.kill()
+        self.assertEquals(['pipeline', 'set', 'delete', 'set', 'execute'],
+                          self.remote[0].callstack)
+        with self.assertRaises(ValueError):
+            redismw.RedisMultiWrite(self.local, self.remote,
+                                    ring_path=ring_path)
+        with self.assertRaises(ValueError):
+            writer.set_everywhere('good', 'value', token=True)
+
+    def test_ring_wraps(self):
+        ring_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, ring_dir)
+        ring = redismw._Ring(ring_dir + '/ring', 256,
+                             eventlet.semaphore.Semaphore())
+        command = [('set', ('good', 'value'))]
+        for i in range(10):
+            written = 0
+            while ring.append(command):
+                written += 1
+            self.assertTrue(written > 0)
+            commands, pos = ring.read(100)
+            self.assertEquals(command * written, commands)
+            ring.ack(pos)
+
+    def test_rate_limits(self):
+        limited = redismw.RedisMultiWrite(self.local, self.remote[:1],
+                                          wait_for_remote=True,
+                                          rate_limits={'remote1:6379': {
+                                              'ops': 100, 'bytes': 10000}})
+        start = time.time()
+        limited.pipeline_everywhere([('set', ('good', 'value'))] * 120)
+        self.assertTrue(time.time() - start >= 0.15)
+        self.assertEquals(120, self.remote[0].callstack.count('set'))
+        rate = limited.stats()['remote1:6379']['rate']
+        self.assertTrue(rate['ops'] > 0.9)
+        self.assertTrue(0 <= rate['bytes'] < 1)
+        limited.set_everywhere(u'caf\xe9', u'\u2603')
+        self.assertEquals(11, redismw._command_size(
+            [('set', (u'caf\xe9', u'\u2603'))]))
+        with self.assertRaises(ValueError):
+            redismw.RedisMultiWrite(self.local, self.remote,
+                                    rate_limits={'remote1:6379': {'calls': 1}})
+
+    def test_lag(self):
+        slow = SlowStrictRedisMock('slow')
+        lagging = redismw.RedisMultiWrite(self.local, [self.remote[0], slow])
+        lagging.set_everywhere('good', 'value')
+        ret, token = lagging.set_everywhere('good', 'value', token=True)
+        self.assertEquals(2, token.seq)
+        eventlet.sleep(0.01)
+        lag = lagging.lag()
+        self.assertEquals({'finished': 2, 'in_flight': 0, 'oldest_age': 0.0,
+                           'failed': 0, 'last_failure_age': None},
+                          lag['remote1:6379'])
+        self.assertEquals(0, lag['slow:6379']['finished'])
+        self.assertEquals(2, lag['slow:6379']['in_flight'])
+        self.assertTrue(lag['slow:6379']['oldest_age'] >= 0.01)
+        slow.gate.send()
+        lagging.wait_replicated(token)
+        eventlet.sleep(0.01)
+        self.assertEquals(2, lagging.lag()['slow:6379']['finished'])
+
+    def test_lag_failures(self):
+        self.redismw.set_everywhere('good', 'value', min_remote_acks=2)
+        eventlet.sleep(0.01)
+        lag = self.redismw.lag()
+        self.assertEquals(0, lag['remote1:6379']['failed'])
+        self.assertEquals(1, lag['remote3:6379']['failed'])
+        self.assertTrue(lag['remote3:6379']['last_failure_age'] < 1)
+
+    def test_timeout_stops_retries(self):
+        broken = self.remote[2]
+        backoff = redismw.RedisMultiWrite(broken, retries=100,
+                                          retry_backoff=0.02)
+        with self.assertRaises(redismw.DeadlineExceeded):
+            backoff.set_everywhere('good', 'value', timeout=0.05)
+        eventlet.sleep(0.1)
+        self.assertTrue(broken.attempts < 10)
+
 # vim:et:fdm=marker:sts=4:sw=4:ts=4